@@ -0,0 +1,41 @@
+import collections
+import threading
+from pyserini.analysis import Analyzer, get_lucene_analyzer
+
+_local = threading.local()
+
+def get_analyzer():
+    """ Lucene analyzer of the calling thread, building one costs reflection and JVM object construction """
+    analyzer = getattr(_local, "analyzer", None)
+    if analyzer is None:
+        analyzer = _local.analyzer = Analyzer(get_lucene_analyzer())
+    return analyzer
+
+class QueryAnalyzer:
+    """ LRU-bounded memo of query text -> analyzed terms on top of the per-thread analyzers """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.memo = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def analyze(self, text):
+        with self.lock:
+            terms = self.memo.get(text)
+            if terms is not None:
+                self.memo.move_to_end(text)
+                self.hits += 1
+                return list(terms)
+            self.misses += 1
+        terms = list(get_analyzer().analyze(text))
+        self._store(text, terms)
+        return list(terms)
+
+    def _store(self, text, terms):
+        with self.lock:
+            self.memo[text] = terms
+            self.memo.move_to_end(text)
+            while len(self.memo) > self.max_size:
+                self.memo.popitem(last=False)
@@ -36,9 +36,9 @@ def remove_punctuation(data):
 	symbols = "!\"#$%&()*+-./:;<=>?@[\]^_`{|}~\n"
 	new_data = []
 	for word in data:
+		new_word = np.char.replace(word, "'", "")
 		for i in symbols:
-			between_word = np.char.replace(word, i, '')
-			new_word = np.char.replace(between_word, "'", "")
+			new_word = np.char.replace(new_word, i, '')
 		new_data.append(new_word)
 	return new_data
 
@@ -1,7 +1,10 @@
 from nltk.stem import PorterStemmer
 from nltk.stem import WordNetLemmatizer
+import collections
+import multiprocessing
 import re
-import numpy as np
+import sys
+import time
 import nltk
 #from nltk.tokenize import word_tokenize 
 
@@ -26,88 +29,144 @@ test_input = {
 	'hfvcv2dw': {'title': 'Detection of Viral and Bacterial Pathogens in Hospitalized Children With Acute Respiratory Illnesses, Chongqing, 2009–2013', 'abstract': "Acute respiratory infections (ARIs) cause large disease burden each year. The codetection of viral and bacterial pathogens is quite common; however, the significance for clinical severity remains controversial. We aimed to identify viruses and bacteria in hospitalized children with ARI and the impact of mixed detections. Hospitalized children with ARI aged ≤16 were recruited from 2009 to 2013 at the Children's Hospital of Chongqing Medical University, Chongqing, China. Nasopharyngeal aspirates (NPAs) were collected for detection of common respiratory viruses by reverse transcription polymerase chain reaction (RT-PCR) or PCR. Bacteria were isolated from NPAs by routine culture methods. Detection and codetection frequencies and clinical features and severity were compared. Of the 3181 hospitalized children, 2375 (74.7%) were detected with ≥1 virus and 707 (22.2%) with ≥1 bacteria, 901 (28.3%) with ≥2 viruses, 57 (1.8%) with ≥2 bacteria, and 542 (17.0%) with both virus and bacteria. The most frequently detected were Streptococcus pneumoniae, respiratory syncytial virus, parainfluenza virus, and influenza virus. Clinical characteristics were similar among different pathogen infections for older group (≥6 years old), with some significant difference for the younger. Cases with any codetection were more likely to present with fever; those with ≥2 virus detections had higher prevalence of cough; cases with virus and bacteria codetection were more likely to have cough and sputum. No significant difference in the risk of pneumonia, severe pneumonia, and intensive care unit admission were found for any codetection than monodetection. There was a high codetection rate of common respiratory pathogens among hospitalized pediatric ARI cases, with fever as a significant predictor. Cases with codetection showed no significant difference in severity than those with single pathogens.", 'introduction': []}
 }
 
+# Same separators as the original re.split('[.|:|?|!| | - ]', text)
+SPLIT = re.compile('[.|:?! ]')
+
+# One str.translate removes every digit (str.isdigit, like the old remove_numbers), punctuation and apostrophe
+SYMBOLS = "!\"#$%&()*+-./:;<=>?@[\\]^_`{|}~\n'"
+DELETE = str.maketrans(dict.fromkeys([ord(c) for c in SYMBOLS] + [i for i in range(sys.maxunicode + 1) if chr(i).isdigit()]))
+
+_stop_words = None
+
 #nltk.download('stopwords')
-def filter_stopwords(data):
-	stop_words = set(nltk.corpus.stopwords.words('english')) 
-	filtered_sentence = [w for w in data if not w in stop_words] 
-	return filtered_sentence
-
-def remove_punctuation(word):
-	symbols = "!\"#$%&()*+-./:;<=>?@[\]^_`{|}~\n"
-	for i in symbols:
-		between_word = np.char.replace(word, i, '')
-		new_word = np.char.replace(between_word, "'", "")
-	return new_word
-
-'''def remove_single_characters(word):
-	if len(str(word)) > 1:
-		new_data.append(str(word))
-	return new_data'''
+def stop_words():
+	""" English stopwords, read from nltk once per process """
+	global _stop_words
+	if _stop_words is None:
+		_stop_words = frozenset(nltk.corpus.stopwords.words('english'))
+	return _stop_words
 
 #nltk.download('wordnet')
-def lemmatize(data, lemmatizer):
-	
-	new_data = []
-	for word in data:
-		new_data.append(lemmatizer.lemmatize(word))
-	return (new_data)
+class Preprocessor:
+	"""
+	Tokenizes, filters and normalizes text. Lemmatizing and stemming cost most of the time, their result
+	is kept per surface form in an LRU cache, with a Zipfian vocabulary most words are cache hits.
+	"""
+
+	def __init__(self, cache_size=100000):
+		self.stemmer = PorterStemmer()
+		self.lemmatizer = WordNetLemmatizer()
+		self.stop_words = stop_words()
+		self.cache_size = cache_size
+		self.cache = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.tokens = 0
+
+	def normalize(self, word):
+		""" Stem of the lemma of a cleaned word """
+		normalized = self.cache.get(word)
+		if normalized is not None:
+			self.cache.move_to_end(word)
+			self.hits += 1
+			return normalized
+		self.misses += 1
+		normalized = self.stemmer.stem(self.lemmatizer.lemmatize(word))
+		self.cache[word] = normalized
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return normalized
+
+	def tokens_of(self, text):
+		""" Preprocessed tokens of a text: split, lowercase, stopwords, digits and punctuation, single characters """
+		tokens = []
+		for word in SPLIT.split(text.lower()):
+			if word in self.stop_words:
+				continue
+			word = word.translate(DELETE)
+			if len(word) <= 1:
+				continue
+			tokens.append(self.normalize(word))
+		self.tokens += len(tokens)
+		return tokens
+
+	def process(self, fields):
+		""" {segment: tokens} of a document, of a segment holding a list only the first item is used """
+		processed = {}
+		for seg, text in fields.items():
+			if not text:
+				continue
+			# Same as preprocess_data.py, the output of both must stay comparable
+			if type(text) is list:
+				text = text[0]
+			processed[seg] = self.tokens_of(text)
+		return processed
+
+	def stats(self):
+		return {"tokens": self.tokens, "cache_hits": self.hits, "cache_misses": self.misses, "cache_entries": len(self.cache)}
 
-def stem(word, stemmer):
-	return(stemmer.stem(word))
+_worker = {}
 
-def remove_numbers(word):
-	result = ''.join(i for i in word if not i.isdigit())
-	return result
+def _init_worker(cache_size):
+	_worker["preprocessor"] = Preprocessor(cache_size)
 
-def preprocessing(data):
+def _process_batch(batch):
+	preprocessor = _worker["preprocessor"]
+	tokens = preprocessor.tokens
+	processed = [(docuid, preprocessor.process(fields)) for docuid, fields in batch]
+	return processed, preprocessor.tokens - tokens
+
+def preprocess_batches(batches, workers=1, cache_size=100000, stats=None):
+	"""
+	Preprocess a stream of batches of (docuid, {segment: text}), like the ones of ingest.ingest without their
+	batch numbers, yielding a list of (docuid, {segment: tokens}) per batch in order. With workers > 1 the
+	batches are divided over processes that each keep their own cache. stats gets tokens and tokens_per_sec.
+	"""
+	stats = stats if stats is not None else {}
+	stats.update(tokens=0, documents=0, seconds=0.0, tokens_per_sec=0.0)
+	start = time.perf_counter()
+
+	def count(processed, tokens):
+		stats["tokens"] += tokens
+		stats["documents"] += len(processed)
+		stats["seconds"] = time.perf_counter() - start
+		stats["tokens_per_sec"] = stats["tokens"] / max(stats["seconds"], 1e-9)
+		return processed
+
+	if workers <= 1:
+		preprocessor = Preprocessor(cache_size)
+		for batch in batches:
+			tokens = preprocessor.tokens
+			processed = [(docuid, preprocessor.process(fields)) for docuid, fields in batch]
+			yield count(processed, preprocessor.tokens - tokens)
+		stats.update(preprocessor.stats())
+		return
+	# spawn, a parent process with a JVM does not survive a fork
+	with multiprocessing.get_context("spawn").Pool(workers, initializer=_init_worker, initargs=(cache_size,)) as pool:
+		for processed, tokens in pool.imap(_process_batch, batches):
+			yield count(processed, tokens)
+
+def preprocessing(data, workers=1, batch_size=1000, stats=None):
 	"""
 	Preprocessing steps help us have a look at the distribution of our data. Some standard steps are:
 		* change characters to lowercase letters
 		* remove stop words
 		* remove punctuation
 		* remove apostrophe
-		* remove stopwords
+		* remove numbers, since we are mostly dealing with medical texts
 		* remove single characters
-		* stemming (PorterStemmer())
 		* lemmatisation (WordNetLemmatizer)
-		* converting numbers (num2word) --> remove punctuation and stopwords again 
-			--> maybe remove numbers in general, since we are mostly dealing with medical texts
+		* stemming (PorterStemmer())
 	"""
-	
-	# Create new dictionary with processed input
+	items = list(data.items())
+	batches = (items[i:i + batch_size] for i in range(0, len(items), batch_size))
 	processed_input = {}
-	processed_between = {}
-
-	# initialize stemmer and lemmatizer
-	stemmer = PorterStemmer()
-	lemmatizer = WordNetLemmatizer()
-
-	for docuid, body in data.items():		
-		for seg, text in body.items():
-			if not text or text=="":
-				continue
-			if type(text) is list:
-				text = text[0]
-			split_value = re.split('[.|:|?|!| | - ]', text)
-			lower_value = np.char.lower(split_value)
-			removed_stopwords = filter_stopwords(lower_value)
-
-			# Following functions can be done within one loop instead of executing each function independently
-			# TODO:  check punctuation removal order
-
-			preprocessed_data = []
-			for word in removed_stopwords:
-				no_numbers = remove_numbers(word)
-				no_punctuation = remove_punctuation(no_numbers)
-				if  len(str(word)) <= 1:
-					continue
-				lemmatized = lemmatizer.lemmatize(str(no_punctuation))
-				stemmed = stemmer.stem(lemmatized)
-				preprocessed_data.append(stemmed)
-			processed_between[seg] = preprocessed_data
-		processed_input[docuid] = processed_between
-
+	for processed in preprocess_batches(batches, workers=workers, stats=stats):
+		processed_input.update(processed)
 	return processed_input
 
-#processed_data = preprocessing(test_input)
-#print(processed_data)
\ No newline at end of file
+if __name__ == "__main__":
+	stats = {}
+	processed_data = preprocessing(test_input, stats=stats)
+	print(processed_data)
+	print("{0} tokens in {1:.3f}s, {2:.0f} tokens/s".format(stats["tokens"], stats["seconds"], stats["tokens_per_sec"]))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import time
+import numpy as np
+from binary_index import BinaryIndex, write_index
+from doc_table import write_doc_table
+import impact_index
+import trec_main
+
+BENCHMARK_DIR = "blob/benchmark"
+
+# name -> the trec_main options that select the algorithm
+ENGINES = {
+    "bm25": {"model": "bm25"},
+    "daat": {"doc_at_a_time": True, "pruning": "none"},
+    "daat-wand": {"doc_at_a_time": True, "pruning": "wand"},
+    "daat-bmw": {"doc_at_a_time": True, "pruning": "bmw"},
+    "taat": {"term_at_a_time": True, "pruning": "none"},
+    "taat-maxscore": {"term_at_a_time": True, "pruning": "maxscore"},
+    "saat": {"impact_index": True},
+    "tf_idf": {"model": "tf_idf"},
+    "rocchio": {"model": "bm25", "rerank": "rocchio"},
+    "ide": {"model": "bm25", "rerank": "ide"},
+}
+
+class JvmCallCounter:
+    """
+    Stands in for IndexReader/SimpleSearcher and counts every method call by name. Calls are passed on to
+    the wrapped object, without one (the synthetic index has no Lucene index) a call fails loudly.
+    """
+
+    def __init__(self, wrapped=None):
+        self.wrapped = wrapped
+        self.calls = {}
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.wrapped is None:
+                raise RuntimeError("{0} needs a Lucene index, the synthetic benchmark index has none".format(name))
+            return getattr(self.wrapped, name)(*args, **kwargs)
+        return call
+
+    def total(self):
+        return sum(self.calls.values())
+
+def zipf_probabilities(vocab_size, s):
+    p = 1.0 / np.arange(1, vocab_size + 1) ** s
+    return p / p.sum()
+
+def build_synthetic_index(path, n_docs=20000, vocab_size=50000, mean_length=120, zipf_s=1.1, seed=42):
+    """
+    Write a CORD-19 abstract-like collection to path as a binary index and a doc table. Document lengths
+    are log-normal around mean_length and the terms follow a Zipf law.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.maximum(1, rng.lognormal(np.log(mean_length), 0.5, n_docs).astype(np.int64))
+    term_ids = rng.choice(vocab_size, size=int(lengths.sum()), p=zipf_probabilities(vocab_size, zipf_s))
+    doc_ids = np.repeat(np.arange(n_docs), lengths)
+    # Sort on (term, doc) and count, which gives the postings of every term with their tfs
+    order = np.lexsort((doc_ids, term_ids))
+    pairs = term_ids[order] * n_docs + doc_ids[order]
+    pairs, tfs = np.unique(pairs, return_counts=True)
+    terms, docs = pairs // n_docs, (pairs % n_docs).astype(np.int32)
+    used = np.unique(terms)
+    bounds = np.searchsorted(terms, used)
+    bounds = np.append(bounds, len(terms))
+    # Names sort on their bytes in term id order, as the binary index requires
+    names = ["t{0:07d}".format(t) for t in used]
+    postings = ((docs[bounds[i]:bounds[i + 1]], tfs[bounds[i]:bounds[i + 1]].astype(np.int32)) for i in range(len(used)))
+    write_index(os.path.join(path, "index"), names, postings, n_docs)
+    index_lengths = np.bincount(docs, weights=tfs, minlength=n_docs).astype(np.int32)
+    write_doc_table(os.path.join(path, "doctable"), ["syn{0:07d}".format(d) for d in range(n_docs)], index_lengths)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"documents": n_docs, "vocab_size": vocab_size, "mean_length": mean_length, "zipf_s": zipf_s, "seed": seed}, f)
+
+def synthetic_index_matches(path, n_docs, vocab_size, zipf_s):
+    """ Whether path holds a synthetic index built with these settings """
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return False
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    return (meta["documents"], meta["vocab_size"], meta["zipf_s"]) == (n_docs, vocab_size, zipf_s)
+
+def make_queries(path, names, df, n_docs, n_queries=50, min_terms=2, max_terms=5, seed=7):
+    """
+    Topics of min_terms to max_terms distinct terms drawn from the mid-frequency terms, each with a few
+    random graded judgements so the rerankers have feedback to work with.
+    """
+    rng = np.random.default_rng(seed)
+    # Skip the stopword-like head and the hapax tail, queries are made of content terms
+    ranked = np.argsort(-df, kind="stable")
+    pool = ranked[len(ranked) // 100:len(ranked) // 5]
+    queries = []
+    with open(os.path.join(path, "qrels.txt"), "w") as f:
+        for topic_id in range(1, n_queries + 1):
+            n_terms = rng.integers(min_terms, max_terms + 1)
+            queries.append((topic_id, [names[t] for t in rng.choice(pool, n_terms, replace=False)]))
+            for doc in rng.choice(n_docs, min(20, n_docs), replace=False):
+                f.write("{0} 0 syn{1:07d} {2}\n".format(topic_id, doc, rng.choice([0, 0, 1, 2])))
+    return queries
+
+def configure(path):
+    """ Point trec_main at the benchmark index """
+    trec_main.verbose = False
+    trec_main.BINARY_INDEX = os.path.join(path, "index")
+    trec_main.DOC_TABLE = os.path.join(path, "doctable")
+    trec_main.IMPACT_INDEX = os.path.join(path, "impact")
+    trec_main.QRELFILE = os.path.join(path, "qrels.txt")
+
+def peak_rss_mb():
+    """ Peak resident set size of this process so far, ru_maxrss is in kB on Linux and in bytes on macOS """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_engine(name, ranker, options, queries, counter, repeat=1):
+    """ Time every query of the set, after one untimed warm-up query """
+    options = dict(options, **ENGINES[name])
+    calls_before = counter.total()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        trec_main.rank_topic(ranker, options, queries[0][0], " ".join(queries[0][1]))
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for topic_id, terms in queries:
+                query_start = time.perf_counter()
+                trec_main.rank_topic(ranker, options, topic_id, " ".join(terms))
+                latencies.append(time.perf_counter() - query_start)
+        elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        "queries": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "qps": len(latencies) / elapsed,
+        "jvm_calls": counter.total() - calls_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def compare(report, baseline, tolerance):
+    """ Print the change of every engine against a baseline report, returns the engines that got slower """
+    regressions = []
+    print("{0:<14} {1:>10} {2:>10} {3:>10} {4:>10}".format("engine", "p50", "p99", "qps", "jvm calls"))
+    for name, result in report["engines"].items():
+        base = baseline["engines"].get(name)
+        if base is None:
+            continue
+        p50, p99 = result["p50_ms"] / base["p50_ms"], result["p99_ms"] / base["p99_ms"]
+        qps = result["qps"] / base["qps"]
+        print("{0:<14} {1:>9.2f}x {2:>9.2f}x {3:>9.2f}x {4:>+10d}".format(name, p50, p99, qps, result["jvm_calls"] - base["jvm_calls"]))
+        if p50 > 1 + tolerance or p99 > 1 + tolerance or result["jvm_calls"] > base["jvm_calls"]:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency, throughput and memory benchmark of the ranking algorithms on a synthetic index")
+    parser.add_argument("--path", help="Directory of the synthetic index", default=BENCHMARK_DIR)
+    parser.add_argument("--docs", help="Number of synthetic documents", type=int, default=20000)
+    parser.add_argument("--vocab", help="Vocabulary size of the synthetic collection", type=int, default=50000)
+    parser.add_argument("--zipf", help="Zipf exponent of the term distribution", type=float, default=1.1)
+    parser.add_argument("--rebuild", help="Rebuild the synthetic index even if it exists", action="store_true", default=False)
+    parser.add_argument("-q", "--queries", help="Number of queries in the query set", type=int, default=50)
+    parser.add_argument("--query_terms", help="Range of query lengths 'min:max'", default="2:5")
+    parser.add_argument("--repeat", help="Number of passes over the query set", type=int, default=1)
+    parser.add_argument("-e", "--engines", help="Comma separated engines from {0}".format(", ".join(ENGINES)), default=",".join(ENGINES))
+    parser.add_argument("-k", "--k_docs", help="Number of documents to retrieve", type=trec_main.positive_int, default=100)
+    parser.add_argument("-o", "--output", help="Write the report as JSON to this file", default=None)
+    parser.add_argument("-c", "--compare", help="Compare with a report written before, exits with 1 on a regression", default=None)
+    parser.add_argument("--tolerance", help="Relative latency increase that counts as a regression", type=float, default=0.2)
+    args = parser.parse_args()
+    engines = args.engines.split(",")
+    for name in engines:
+        if name not in ENGINES:
+            parser.error("unknown engine {0}".format(name))
+
+    if args.rebuild or not synthetic_index_matches(args.path, args.docs, args.vocab, args.zipf):
+        print("Building synthetic index of {0} documents".format(args.docs))
+        # The impact index of the previous collection is stale
+        shutil.rmtree(os.path.join(args.path, "impact"), ignore_errors=True)
+        build_synthetic_index(args.path, n_docs=args.docs, vocab_size=args.vocab, zipf_s=args.zipf)
+    configure(args.path)
+    if "saat" in engines and not impact_index.exists(trec_main.IMPACT_INDEX, k1=trec_main.k1_param, b=trec_main.b_param,
+            binary_index_path=trec_main.BINARY_INDEX):
+        impact_index.build_impact_index(trec_main.IMPACT_INDEX, trec_main.BINARY_INDEX, k1=trec_main.k1_param, b=trec_main.b_param)
+
+    index = BinaryIndex(trec_main.BINARY_INDEX)
+    names = [index.terms[i] for i in range(len(index.terms))]
+    min_terms, max_terms = (int(value) for value in args.query_terms.split(":"))
+    queries = make_queries(args.path, names, np.asarray(index.df), index.num_docs(), n_queries=args.queries, min_terms=min_terms, max_terms=max_terms)
+    # Queries are made of index terms already, seed the analyzer memo so no query goes through Lucene's analyzer
+    for _, terms in queries:
+        trec_main.query_analyzer._store(" ".join(terms), terms)
+
+    options = {"binary_index": True, "term_stats": False, "doc_vectors": False, "doc_cache_mb": 256, "result_cache": False,
+        "model": "bm25", "doc_at_a_time": False, "term_at_a_time": False, "impact_index": "saat" in engines, "fields": False, "budget": None,
+        "pruning": "none", "k_docs": args.k_docs, "rerank": "none"}
+    counter = JvmCallCounter()
+    ranker = trec_main.load_ranker(options, counter, counter)
+    report = {"config": dict(vars(args), **{"rss_after_load_mb": peak_rss_mb()}), "engines": {}}
+    for name in engines:
+        report["engines"][name] = result = run_engine(name, ranker, options, queries, counter, repeat=args.repeat)
+        print("{0:<14} p50 {1:8.2f} ms  p99 {2:8.2f} ms  {3:8.1f} qps  {4} JVM calls  {5:.0f} MB peak RSS".format(
+            name, result["p50_ms"], result["p99_ms"], result["qps"], result["jvm_calls"], result["peak_rss_mb"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions: {0}".format(", ".join(regressions)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+import numpy as np
+from progress.bar import Bar
+
+FORMAT_VERSION = 1
+BLOCK_SIZE = 128
+
+def varint_encode(values):
+    """ LEB128 encode an array of non-negative integers into a uint8 array """
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+    owner = np.repeat(np.arange(len(values)), n_bytes)
+    starts = np.cumsum(n_bytes) - n_bytes
+    pos = np.arange(len(owner)) - starts[owner]
+    data = ((values[owner] >> (np.uint64(7) * pos.astype(np.uint64))) & np.uint64(0x7f)).astype(np.uint8)
+    data[pos < n_bytes[owner] - 1] |= 0x80
+    return data, n_bytes
+
+def varint_decode(data):
+    """ Decode a uint8 array of LEB128 integers (values have to fit in 53 bits) """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    boundaries = np.zeros(len(data), dtype=np.int64)
+    boundaries[ends[:-1] + 1] = 1
+    owner = np.cumsum(boundaries)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    pos = np.arange(len(data)) - starts[owner]
+    weights = (data & 0x7f).astype(np.float64) * np.exp2(7 * pos)
+    return np.bincount(owner, weights=weights, minlength=len(ends)).astype(np.int64)
+
+def block_layout(n, block_size=BLOCK_SIZE):
+    """
+    Postings are written in blocks of block_size, each block holds its doc gaps followed by its tfs.
+    Returns the position of every doc gap and tf in that layout.
+    """
+    i = np.arange(n)
+    block_start = (i // block_size) * block_size
+    block_len = np.minimum(block_size, n - block_start)
+    doc_pos = block_start + i
+    tf_pos = block_start + block_len + i
+    return doc_pos, tf_pos
+
+def encode_postings(docs, tfs, block_size=BLOCK_SIZE):
+    """ Delta/varint compress sorted postings, returns (bytes, block last docs, block byte offsets) """
+    docs = np.asarray(docs, dtype=np.int64)
+    gaps = np.diff(docs, prepend=0)
+    values = np.empty(2 * len(docs), dtype=np.int64)
+    doc_pos, tf_pos = block_layout(len(docs), block_size)
+    values[doc_pos] = gaps
+    values[tf_pos] = tfs
+    data, n_bytes = varint_encode(values)
+    value_offsets = np.concatenate(([0], np.cumsum(n_bytes)))
+    block_starts = np.arange(0, len(docs), block_size)
+    block_last_doc = docs[np.minimum(block_starts + block_size, len(docs)) - 1]
+    return data, block_last_doc, value_offsets[2 * block_starts]
+
+def decode_postings(data, n, first_doc=0, block_size=BLOCK_SIZE):
+    """ Inverse of encode_postings for n postings, first_doc is the doc the first gap is relative to """
+    values = varint_decode(data)
+    doc_pos, tf_pos = block_layout(n, block_size)
+    docs = np.cumsum(values[doc_pos]) + first_doc
+    return docs.astype(np.int32), values[tf_pos].astype(np.int32)
+
+def write_term_dictionary(path, terms):
+    """ Write terms, sorted on their utf-8 bytes, as one blob plus an offsets array """
+    os.makedirs(path, exist_ok=True)
+    encoded_terms = [term.encode("utf-8") for term in terms]
+    term_offsets = np.concatenate(([0], np.cumsum([len(t) for t in encoded_terms]))).astype(np.int64)
+    with open(os.path.join(path, "terms.bin"), "wb") as f:
+        f.write(b"".join(encoded_terms))
+    np.save(os.path.join(path, "term_offsets.npy"), term_offsets)
+
+def write_index(path, terms, postings, n_docs, block_size=BLOCK_SIZE, forward=True, bar=None):
+    """
+    Write a binary index to directory path. terms must be sorted on their utf-8 bytes and postings
+    yields one (docs, tfs) pair of sorted arrays per term in the same order.
+    """
+    write_term_dictionary(path, terms)
+
+    df = np.zeros(len(terms), dtype=np.int32)
+    cf = np.zeros(len(terms), dtype=np.int64)
+    term_blocks = [0]
+    block_last_docs = []
+    block_offsets = []
+    # Postings are only kept for the forward index, document lengths are summed term by term
+    all_docs, all_tfs = [], []
+    doc_lengths = np.zeros(n_docs, dtype=np.int64)
+    offset = 0
+    with open(os.path.join(path, "postings.bin"), "wb") as f:
+        for term_id, (docs, tfs) in enumerate(postings):
+            data, last_docs, offsets = encode_postings(docs, tfs, block_size)
+            f.write(data.tobytes())
+            df[term_id] = len(docs)
+            cf[term_id] = np.sum(tfs)
+            block_last_docs.append(last_docs)
+            block_offsets.append(offsets + offset)
+            term_blocks.append(term_blocks[-1] + len(last_docs))
+            offset += len(data)
+            # The docs of a term are unique, so a fancy-indexed add needs no np.add.at
+            doc_lengths[docs] += tfs
+            if forward:
+                all_docs.append(np.asarray(docs, dtype=np.int32))
+                all_tfs.append(np.asarray(tfs, dtype=np.int32))
+            if bar is not None:
+                bar.next()
+    block_offsets.append([offset])
+
+    np.save(os.path.join(path, "df.npy"), df)
+    np.save(os.path.join(path, "cf.npy"), cf)
+    np.save(os.path.join(path, "term_blocks.npy"), np.asarray(term_blocks, dtype=np.int64))
+    np.save(os.path.join(path, "block_last_doc.npy"), np.concatenate(block_last_docs or [[]]).astype(np.int32))
+    np.save(os.path.join(path, "block_offsets.npy"), np.concatenate(block_offsets).astype(np.int64))
+
+    doc_lengths = doc_lengths.astype(np.int32)
+    np.save(os.path.join(path, "doc_lengths.npy"), doc_lengths)
+    if forward:
+        docs = np.concatenate(all_docs or [np.empty(0, dtype=np.int32)])
+        tfs = np.concatenate(all_tfs or [np.empty(0, dtype=np.int32)])
+        # Transpose the inverted index, a stable sort keeps the term ids of every document ascending
+        term_ids = np.repeat(np.arange(len(terms), dtype=np.int32), df)
+        order = np.argsort(docs, kind="stable")
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(docs, minlength=n_docs)))).astype(np.int64)
+        np.save(os.path.join(path, "fwd_indptr.npy"), indptr)
+        np.save(os.path.join(path, "fwd_terms.npy"), term_ids[order])
+        np.save(os.path.join(path, "fwd_tfs.npy"), tfs[order])
+
+    meta = {
+        "version": FORMAT_VERSION,
+        "block_size": block_size,
+        "documents": int(n_docs),
+        "non_empty_documents": int(np.count_nonzero(doc_lengths)),
+        "unique_terms": len(terms),
+        "total_terms": int(cf.sum()),
+        "forward": forward,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+def export_index(index_reader, path, block_size=BLOCK_SIZE):
+    """ Walk the Lucene index once and write all of its postings to a binary index at path """
+    terms = sorted((term.term for term in index_reader.terms()), key=lambda t: t.encode("utf-8"))
+    n_docs = index_reader.stats()['documents']
+
+    def postings():
+        for term in terms:
+            plist = index_reader.get_postings_list(term, analyzer=None) or []
+            docs = np.fromiter((p.docid for p in plist), dtype=np.int32, count=len(plist))
+            tfs = np.fromiter((p.tf for p in plist), dtype=np.int32, count=len(plist))
+            order = np.argsort(docs, kind="stable")
+            yield docs[order], tfs[order]
+
+    bar = Bar("Exporting postings", max=len(terms))
+    write_index(path, terms, postings(), n_docs, block_size=block_size, bar=bar)
+    bar.finish()
+
+def fingerprint(path):
+    """ Hash of the meta.json of a binary index and the size and modification time of its postings, changes whenever the index is rewritten """
+    digest = hashlib.sha1()
+    with open(os.path.join(path, "meta.json"), "rb") as f:
+        digest.update(f.read())
+    stat = os.stat(os.path.join(path, "postings.bin"))
+    digest.update("{0}\0{1}".format(stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+class TermDictionary:
+    """ Sorted utf-8 term dictionary, looked up with a binary search over the memory-mapped term blob """
+
+    def __init__(self, path):
+        self.offsets = np.load(os.path.join(path, "term_offsets.npy"), mmap_mode="r")
+        if self.offsets[-1] > 0:
+            self.blob = np.memmap(os.path.join(path, "terms.bin"), dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.empty(0, dtype=np.uint8)
+        # term -> id resolved ahead of time, such as the terms of compiled topics
+        self.resolved = {}
+
+    def add_term_ids(self, term_ids):
+        """ Remember ids of terms looked up in this dictionary before, lookup() then skips the binary search """
+        self.resolved.update(term_ids)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id):
+        return self.term_bytes(term_id).decode("utf-8")
+
+    def term_bytes(self, term_id):
+        return self.blob[self.offsets[term_id]:self.offsets[term_id + 1]].tobytes()
+
+    def lookup(self, term):
+        """ Returns the id of term, or -1 if it is not in the dictionary """
+        term_id = self.resolved.get(term)
+        if term_id is not None:
+            return term_id
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.term_bytes(lo) == key:
+            return lo
+        return -1
+
+class BinaryIndex:
+    """ Read-only view on an index written by write_index, every array is memory-mapped """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported binary index version {0} in {1}".format(self.meta["version"], path))
+        self.block_size = self.meta["block_size"]
+        self.terms = TermDictionary(path)
+        self.df = self._load("df.npy")
+        self.cf = self._load("cf.npy")
+        self.term_blocks = self._load("term_blocks.npy")
+        self.block_last_doc = self._load("block_last_doc.npy")
+        self.block_offsets = self._load("block_offsets.npy")
+        self.doc_lengths = self._load("doc_lengths.npy")
+        self.postings = np.memmap(os.path.join(path, "postings.bin"), dtype=np.uint8, mode="r") \
+            if self.block_offsets[-1] > 0 else np.empty(0, dtype=np.uint8)
+        if self.meta["forward"]:
+            self.fwd_indptr = self._load("fwd_indptr.npy")
+            self.fwd_terms = self._load("fwd_terms.npy")
+            self.fwd_tfs = self._load("fwd_tfs.npy")
+
+    def _load(self, filename):
+        return np.load(os.path.join(self.path, filename), mmap_mode="r")
+
+    def stats(self):
+        """ Same keys as IndexReader.stats() """
+        return {key: self.meta[key] for key in ("documents", "non_empty_documents", "unique_terms", "total_terms")}
+
+    def num_docs(self):
+        return self.meta["documents"]
+
+    def term_id(self, term):
+        return self.terms.lookup(term)
+
+    def get_term_counts(self, term):
+        """ (df, cf) of term, like IndexReader.get_term_counts """
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return 0, 0
+        return int(self.df[term_id]), int(self.cf[term_id])
+
+    def get_postings_by_id(self, term_id):
+        first, last = self.term_blocks[term_id], self.term_blocks[term_id + 1]
+        data = self.postings[self.block_offsets[first]:self.block_offsets[last]]
+        return decode_postings(data, int(self.df[term_id]), block_size=self.block_size)
+
+    def get_postings(self, term):
+        """ (docs, tfs) int32 arrays of term, or None if the term is not in the index """
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return None
+        return self.get_postings_by_id(term_id)
+
+    def get_doc_length(self, docidx):
+        return int(self.doc_lengths[docidx])
+
+    def get_document_row(self, docidx):
+        """ (term ids, tfs) of a document from the forward index """
+        start, end = self.fwd_indptr[docidx], self.fwd_indptr[docidx + 1]
+        return self.fwd_terms[start:end], self.fwd_tfs[start:end]
+
+    def get_document_vector(self, docidx):
+        """ {term: tf} of a document, like IndexReader.get_document_vector """
+        term_ids, tfs = self.get_document_row(docidx)
+        return {self.terms[int(t)]: int(tf) for t, tf in zip(term_ids, tfs)}
@@ -0,0 +1,98 @@
+import collections
+import numpy as np
+
+# Rough per-entry cost of the OrderedDict slot and the two array headers
+ENTRY_OVERHEAD = 256
+
+class Vocabulary:
+    """ Process-local term <-> id mapping, used when there is no term dictionary on disk """
+
+    def __init__(self):
+        self.ids = {}
+        self.terms = []
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getitem__(self, term_id):
+        return self.terms[term_id]
+
+    def lookup(self, term):
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+class DocumentVectorCache:
+    """
+    LRU cache of document vectors keyed on docidx, every document is kept as sorted int32 term id / tf arrays.
+    The cache evicts the least recently used documents once the stored arrays exceed max_bytes.
+    Documents come from the forward index of a BinaryIndex if there is one, otherwise from Lucene.
+    """
+
+    def __init__(self, index_reader, max_bytes=256 * 1024 * 1024, binary_index=None, doc_table=None, terms=None):
+        self.index_reader = index_reader
+        self.binary_index = binary_index
+        self.doc_table = doc_table
+        if binary_index is not None:
+            self.terms = binary_index.terms
+        else:
+            # Share the ids of a TermStats dictionary when there is one, so rows line up with its df/idf arrays
+            self.terms = terms if terms is not None else Vocabulary()
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _fetch(self, docidx):
+        if self.binary_index is not None:
+            term_ids, tfs = self.binary_index.get_document_row(docidx)
+            return np.array(term_ids, dtype=np.int32), np.array(tfs, dtype=np.int32)
+        if self.doc_table is not None:
+            docid = self.doc_table.docid(docidx)
+        else:
+            docid = self.index_reader.convert_internal_docid_to_collection_docid(docidx)
+        vector = self.index_reader.get_document_vector(docid)
+        term_ids = np.fromiter((self.terms.lookup(term) for term in vector.keys()), dtype=np.int32, count=len(vector))
+        tfs = np.fromiter(vector.values(), dtype=np.int32, count=len(vector))
+        order = np.argsort(term_ids)
+        return term_ids[order], tfs[order]
+
+    def get(self, docidx):
+        """ (term ids, tfs) of a document """
+        entry = self.entries.get(docidx)
+        if entry is not None:
+            self.entries.move_to_end(docidx)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self._fetch(docidx)
+        self.entries[docidx] = entry
+        self.bytes += self.entry_size(entry)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self.entry_size(evicted)
+            self.evictions += 1
+        return entry
+
+    def entry_size(self, entry):
+        return entry[0].nbytes + entry[1].nbytes + ENTRY_OVERHEAD
+
+    def get_vector(self, docidx):
+        """ {term: tf} of a document, like IndexReader.get_document_vector """
+        term_ids, tfs = self.get(docidx)
+        return {self.terms[int(t)]: int(tf) for t, tf in zip(term_ids, tfs)}
+
+    def get_length(self, docidx):
+        """ Number of indexed terms in a document """
+        if self.binary_index is not None:
+            return self.binary_index.get_doc_length(docidx)
+        if self.doc_table is not None:
+            return int(self.doc_table.lengths[docidx])
+        return int(self.get(docidx)[1].sum())
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "documents": len(self.entries), "bytes": self.bytes}
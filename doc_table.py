@@ -0,0 +1,147 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import numpy as np
+from progress.bar import Bar
+import binary_index
+from result_cache import index_fingerprint
+
+def docid_hash(docid):
+    """ Stable 64-bit hash of an external docid, Python's hash() is salted per process """
+    return int.from_bytes(hashlib.blake2b(docid.encode("utf-8"), digest_size=8).digest(), "little")
+
+def write_doc_table(path, docids, lengths):
+    """ Write docids (fixed-width bytes), int32 lengths and the sorted docid hash index to path """
+    os.makedirs(path, exist_ok=True)
+    docids = np.asarray([docid.encode("utf-8") for docid in docids], dtype=np.bytes_)
+    hashes = np.fromiter((docid_hash(docid.decode("utf-8")) for docid in docids), dtype=np.uint64, count=len(docids))
+    order = np.argsort(hashes, kind="stable")
+    np.save(os.path.join(path, "docids.npy"), docids)
+    np.save(os.path.join(path, "lengths.npy"), np.asarray(lengths, dtype=np.int32))
+    np.save(os.path.join(path, "hash_keys.npy"), hashes[order])
+    np.save(os.path.join(path, "hash_docidx.npy"), order.astype(np.int32))
+
+def from_mapping(mapping, path):
+    """ Convert an old {docidx: (docid, length)} mapping (blob/mapping.pickle) into a doc table """
+    n_docs = len(mapping)
+    write_doc_table(path, [mapping[docidx][0] for docidx in range(n_docs)], [mapping[docidx][1] for docidx in range(n_docs)])
+
+_worker = {}
+
+def _init_worker(lucene_index, binary_index_path):
+    from pyserini.index import IndexReader
+    from pyserini.search import SimpleSearcher
+    _worker["index_reader"] = IndexReader(lucene_index)
+    _worker["searcher"] = SimpleSearcher(lucene_index)
+    _worker["doc_lengths"] = None
+    if binary_index_path is not None:
+        _worker["doc_lengths"] = np.load(os.path.join(binary_index_path, "doc_lengths.npy"), mmap_mode="r")
+
+def _build_chunk(task):
+    """ Look up docids and lengths of docidx range [start, end) and store them as one chunk file """
+    start, end, chunk_file = task
+    searcher = _worker["searcher"]
+    docids = [searcher.doc(docidx).docid() for docidx in range(start, end)]
+    if _worker["doc_lengths"] is not None:
+        lengths = np.asarray(_worker["doc_lengths"][start:end], dtype=np.int32)
+    else:
+        index_reader = _worker["index_reader"]
+        lengths = np.asarray([sum(index_reader.get_document_vector(docid).values()) for docid in docids], dtype=np.int32)
+    # Write to a temporary name first so an interrupted build never leaves a half written chunk behind
+    tmp_file = chunk_file + ".tmp.npz"
+    np.savez(tmp_file, docids=np.asarray(docids), lengths=lengths)
+    os.replace(tmp_file, chunk_file)
+    return end - start
+
+def build_doc_table(path, lucene_index, n_docs, binary_index_path=None, workers=None, chunk_size=10000):
+    """
+    Build the doc table in parallel, every worker opens its own Lucene index. Finished chunks are kept
+    in path/chunks until the table is written, so an interrupted build with the same settings resumes
+    where it stopped and a complete one is always computed again.
+    """
+    settings = {"documents": n_docs, "chunk_size": chunk_size, "index": index_fingerprint(lucene_index),
+        "lengths": binary_index.fingerprint(binary_index_path) if binary_index_path is not None else "lucene"}
+    chunk_dir = os.path.join(path, "chunks")
+    # Chunks of another Lucene index, length source or chunk layout must not end up in the same table
+    if read_settings(os.path.join(chunk_dir, "settings.json")) != settings:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    os.makedirs(chunk_dir, exist_ok=True)
+    with open(os.path.join(chunk_dir, "settings.json"), "w") as f:
+        json.dump(settings, f)
+    tasks = []
+    for start in range(0, n_docs, chunk_size):
+        end = min(start + chunk_size, n_docs)
+        chunk_file = os.path.join(chunk_dir, "chunk-{0:09d}.npz".format(start))
+        if not os.path.exists(chunk_file):
+            tasks.append((start, end, chunk_file))
+
+    if tasks:
+        bar = Bar("Building doc table", max=sum(end - start for start, end, _ in tasks))
+        # spawn, the parent process already runs a JVM which does not survive a fork
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers, initializer=_init_worker, initargs=(lucene_index, binary_index_path)) as pool:
+            for n in pool.imap_unordered(_build_chunk, tasks):
+                bar.next(n)
+        bar.finish()
+
+    docids, lengths = [], []
+    for start in range(0, n_docs, chunk_size):
+        with np.load(os.path.join(chunk_dir, "chunk-{0:09d}.npz".format(start))) as chunk:
+            docids.extend(chunk["docids"].tolist())
+            lengths.append(chunk["lengths"])
+    write_doc_table(path, docids, np.concatenate(lengths) if lengths else [])
+    shutil.rmtree(chunk_dir)
+
+def read_settings(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def exists(path):
+    return os.path.exists(os.path.join(path, "hash_docidx.npy"))
+
+class DocTable:
+    """
+    Memory-mapped docidx -> (docid, length) table. Indexing with a docidx returns the same
+    (docid, length) tuple the old mapping dict did, docidx() does the reverse lookup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.docids = self._load("docids.npy")
+        self.lengths = self._load("lengths.npy")
+        self.hash_keys = self._load("hash_keys.npy")
+        self.hash_docidx = self._load("hash_docidx.npy")
+
+    def _load(self, filename):
+        return np.load(os.path.join(self.path, filename), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.docids)
+
+    def _check(self, docidx):
+        # A negative docidx would silently index from the end, -1 is what docidx() returns for unknown docids
+        if not 0 <= docidx < len(self.docids):
+            raise IndexError("docidx {0} is not in the document table".format(docidx))
+
+    def __getitem__(self, docidx):
+        self._check(docidx)
+        return self.docid(docidx), int(self.lengths[docidx])
+
+    def docid(self, docidx):
+        self._check(docidx)
+        return self.docids[docidx].decode("utf-8")
+
+    def docidx(self, docid):
+        """ Internal docidx of an external docid, -1 if it is not in the table """
+        key = np.uint64(docid_hash(docid))
+        pos = int(np.searchsorted(self.hash_keys, key))
+        while pos < len(self.hash_keys) and self.hash_keys[pos] == key:
+            docidx = int(self.hash_docidx[pos])
+            if self.docid(docidx) == docid:
+                return docidx
+            pos += 1
+        return -1
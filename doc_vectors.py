@@ -0,0 +1,118 @@
+import json
+import multiprocessing
+import os
+import shutil
+import numpy as np
+from progress.bar import Bar
+import binary_index
+from binary_index import BinaryIndex
+from engine import lucene_doc_lengths
+
+WEIGHTS = ("tfidf", "bm25")
+
+def _build_chunk(task):
+    """ tf-idf and BM25 weights of the documents in [start, end), written as one CSR chunk file """
+    binary_index_path, start, end, k1, b, dtype, chunk_file = task
+    index = BinaryIndex(binary_index_path)
+    stats = index.stats()
+    df = np.asarray(index.df, dtype=np.float64)
+    # tf-idf as in Models.tf_idf_docid, BM25 as Lucene computes it
+    tf_idf_idf = np.log(stats['documents'] / (df + 1))
+    n_field = stats['non_empty_documents']
+    bm25_idf = np.log(1 + (n_field - df + 0.5) / (df + 0.5))
+    avgdl = stats['total_terms'] / n_field
+
+    lo, hi = index.fwd_indptr[start], index.fwd_indptr[end]
+    indptr = np.asarray(index.fwd_indptr[start:end + 1]) - lo
+    term_ids = np.asarray(index.fwd_terms[lo:hi])
+    tfs = np.asarray(index.fwd_tfs[lo:hi], dtype=np.float64)
+    doc_lengths = np.asarray(index.doc_lengths[start:end], dtype=np.float64)
+    row_lengths = np.repeat(doc_lengths, np.diff(indptr))
+    norms = np.repeat(k1 * (1 - b + b * lucene_doc_lengths(doc_lengths) / avgdl), np.diff(indptr))
+
+    tfidf = tfs / np.maximum(row_lengths, 1) * tf_idf_idf[term_ids]
+    bm25 = bm25_idf[term_ids] * tfs / (tfs + norms)
+    tmp_file = chunk_file + ".tmp.npz"
+    np.savez(tmp_file, indptr=indptr, terms=term_ids.astype(np.int32), tfidf=tfidf.astype(dtype), bm25=bm25.astype(dtype))
+    os.replace(tmp_file, chunk_file)
+    return end - start
+
+def build_doc_vectors(path, binary_index_path, k1=0.9, b=0.4, dtype="float32", workers=None, chunk_size=20000):
+    """
+    Compute the tf-idf and BM25 vector of every document from the forward index of a binary index and
+    store them as one CSR matrix of memory-mappable .npy files. Chunks are computed in a process pool and
+    kept in path/chunks, so an interrupted build with the same settings resumes where it stopped.
+    """
+    n_docs = BinaryIndex(binary_index_path).num_docs()
+    settings = {"k1": k1, "b": b, "dtype": dtype, "chunk_size": chunk_size, "index": binary_index.fingerprint(binary_index_path)}
+    chunk_dir = os.path.join(path, "chunks")
+    # Chunks of another k1/b, dtype or binary index must not end up in the same store
+    if read_settings(os.path.join(chunk_dir, "settings.json")) != settings:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    os.makedirs(chunk_dir, exist_ok=True)
+    with open(os.path.join(chunk_dir, "settings.json"), "w") as f:
+        json.dump(settings, f)
+    chunk_files = []
+    tasks = []
+    for start in range(0, n_docs, chunk_size):
+        end = min(start + chunk_size, n_docs)
+        chunk_file = os.path.join(chunk_dir, "chunk-{0:09d}.npz".format(start))
+        chunk_files.append(chunk_file)
+        if not os.path.exists(chunk_file):
+            tasks.append((binary_index_path, start, end, k1, b, dtype, chunk_file))
+
+    if tasks:
+        bar = Bar("Computing document vectors", max=sum(task[2] - task[1] for task in tasks))
+        # spawn, the parent process may already run a JVM which does not survive a fork
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            for n in pool.imap_unordered(_build_chunk, tasks):
+                bar.next(n)
+        bar.finish()
+
+    indptr, terms, weights = [np.zeros(1, dtype=np.int64)], [], {name: [] for name in WEIGHTS}
+    for chunk_file in chunk_files:
+        with np.load(chunk_file) as chunk:
+            indptr.append(chunk["indptr"][1:] + indptr[-1][-1])
+            terms.append(chunk["terms"])
+            for name in WEIGHTS:
+                weights[name].append(chunk[name])
+    np.save(os.path.join(path, "indptr.npy"), np.concatenate(indptr).astype(np.int64))
+    np.save(os.path.join(path, "terms.npy"), np.concatenate(terms) if terms else np.empty(0, dtype=np.int32))
+    for name in WEIGHTS:
+        np.save(os.path.join(path, "{0}.npy".format(name)), np.concatenate(weights[name]) if terms else np.empty(0, dtype=dtype))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"documents": n_docs, "k1": k1, "b": b, "dtype": dtype, "binary_index": binary_index_path,
+            "index": settings["index"]}, f)
+
+def read_settings(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def exists(path, binary_index_path=None, k1=None, b=None):
+    """ Whether document vectors are built at path, from the current binary index and for (k1, b) if they are given """
+    meta = read_settings(os.path.join(path, "meta.json"))
+    if meta is None:
+        return False
+    if binary_index_path is not None and meta.get("index") != binary_index.fingerprint(binary_index_path):
+        return False
+    return (k1 is None or meta["k1"] == k1) and (b is None or meta["b"] == b)
+
+class DocumentVectors:
+    """ Memory-mapped CSR matrix of precomputed tf-idf and BM25 document vectors, one row per docidx """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.terms = np.load(os.path.join(path, "terms.npy"), mmap_mode="r")
+        self.weights = {name: np.load(os.path.join(path, "{0}.npy".format(name)), mmap_mode="r") for name in WEIGHTS}
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def get_row(self, docidx, weights="tfidf"):
+        """ (term ids, weights) of a document """
+        start, end = self.indptr[docidx], self.indptr[docidx + 1]
+        return self.terms[start:end], self.weights[weights][start:end]
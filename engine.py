@@ -0,0 +1,155 @@
+import math
+import numpy as np
+import instrumentation
+from index_trec import InvertedList, SKIP_BLOCK_SIZE
+
+# Lucene keeps document lengths as a single byte norm (SmallFloat.intToByte4), lengths below this
+# value are stored exactly, larger lengths keep only their four most significant bits.
+NUM_FREE_VALUES = 24
+
+def lucene_doc_lengths(lengths):
+    """ Round document lengths the same way Lucene does when it encodes them into norms """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    x = np.maximum(lengths - NUM_FREE_VALUES, 0)
+    n_bits = np.zeros(x.shape, dtype=np.int64)
+    nonzero = x > 0
+    n_bits[nonzero] = np.floor(np.log2(x[nonzero])).astype(np.int64) + 1
+    shift = np.maximum(n_bits - 4, 0)
+    decoded = ((x >> shift) << shift) + NUM_FREE_VALUES
+    return np.where(lengths < NUM_FREE_VALUES, lengths, decoded).astype(np.float32)
+
+def top_k(candidates, scores, k):
+    """
+    Select the k highest scoring candidates, returns [(score, docidx)] sorted on descending score and then
+    on ascending docidx, also for the candidates that tie with the k-th score
+    """
+    if len(candidates) > k:
+        # argpartition keeps an arbitrary subset of the candidates tied at the cut-off, take the lowest docidx
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)
+        top = np.concatenate((above, tied[np.argsort(candidates[tied], kind="stable")[:k - len(above)]]))
+        candidates, scores = candidates[top], scores[top]
+    order = np.lexsort((candidates, -scores))
+    return [(float(scores[i]), int(candidates[i])) for i in order]
+
+class PostingsEngine:
+    """
+    Scores queries directly on postings arrays instead of asking Lucene for one BM25 weight per (doc, term).
+    Postings of a term are fetched once as (int32 docidx, float32 tf) arrays and scored in a single vectorized pass,
+    scores are accumulated in a dense array indexed by docidx and the top-k is selected with argpartition.
+    """
+
+    def __init__(self, index_reader, doc_lengths, k1=0.9, b=0.4, cache_size=4096, binary_index=None):
+        self.index_reader = index_reader
+        # Postings and statistics come from the BinaryIndex if one is given, otherwise from Lucene
+        self.binary_index = binary_index
+        stats = (self.index_reader if self.binary_index is None else self.binary_index).stats()
+        # Lucene uses the number of documents that have the field for both the idf and the average length
+        self.N = stats['non_empty_documents']
+        self.avgdl = stats['total_terms'] / self.N
+        self.doc_lengths = lucene_doc_lengths(doc_lengths)
+        self.n_docs = len(self.doc_lengths)
+        self.cache_size = cache_size
+        self.postings_cache = {}
+        self.set_parameters(k1, b)
+
+    def set_parameters(self, k1, b):
+        """ Precompute the length normalisation k1 * (1 - b + b * dl / avgdl) for every document """
+        self.k1 = k1
+        self.b = b
+        self.norms = (self.k1 * (1 - self.b + self.b * self.doc_lengths / self.avgdl)).astype(np.float32)
+
+    def get_postings(self, term):
+        """ Returns (docs, tfs) arrays for an analyzed term, empty arrays if the term is not in the index """
+        if term in self.postings_cache:
+            return self.postings_cache[term]
+        if self.binary_index is not None:
+            postings = self.binary_index.get_postings(term)
+            if postings is not None:
+                postings = (postings[0], postings[1].astype(np.float32))
+            return self._cache_postings(term, postings)
+        postings = self.index_reader.get_postings_list(term, analyzer=None)
+        if postings is not None:
+            docs = np.fromiter((posting.docid for posting in postings), dtype=np.int32, count=len(postings))
+            tfs = np.fromiter((posting.tf for posting in postings), dtype=np.float32, count=len(postings))
+            order = np.argsort(docs, kind="stable")
+            postings = (docs[order], tfs[order])
+        return self._cache_postings(term, postings)
+
+    def _cache_postings(self, term, postings):
+        if postings is None:
+            postings = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+        if len(self.postings_cache) >= self.cache_size:
+            self.postings_cache.pop(next(iter(self.postings_cache)))
+        self.postings_cache[term] = postings
+        return postings
+
+    def idf(self, df):
+        return math.log(1 + (self.N - df + 0.5) / (df + 0.5))
+
+    def bm25_term_scores(self, term):
+        """ BM25 weight of term for every document in its postings list, as (docs, scores) """
+        docs, tfs = self.get_postings(term)
+        scores = self.idf(len(docs)) * tfs / (tfs + self.norms[docs])
+        return docs, scores
+
+    def get_inverted_list(self, term, block_size=SKIP_BLOCK_SIZE):
+        """ InvertedList of term carrying the BM25 score of every posting, for document-at-a-time processing """
+        docs, tfs = self.get_postings(term)
+        _, scores = self.bm25_term_scores(term)
+        return InvertedList(term, docs, tfs, block_size=block_size, scores=scores)
+
+    def top_k(self, candidates, scores, k):
+        return top_k(candidates, scores, k)
+
+    def score_query(self, query, k):
+        """ Term-by-term BM25 scoring of an analyzed query into a score accumulator """
+        accumulator = np.zeros(self.n_docs, dtype=np.float32)
+        docs_list = []
+        for term in query:
+            docs, scores = self.bm25_term_scores(term)
+            # docs are unique within a postings list, so a plain fancy-index add is safe
+            accumulator[docs] += scores
+            docs_list.append(docs)
+        if not docs_list:
+            return []
+        candidates = np.unique(np.concatenate(docs_list))
+        instrumentation.count("candidates.scored", len(candidates))
+        return self.top_k(candidates, accumulator[candidates], k)
+
+    def score_query_taat(self, query, k, maxscore=True):
+        """
+        Term-at-a-time BM25 into a dense float32 accumulator, terms are processed from highest to lowest idf.
+        With maxscore, once the k-th best accumulator beats the summed maximum scores of the remaining terms,
+        documents without an accumulator can no longer reach the top-k and the remaining terms only update
+        existing accumulators.
+
+        Returns ([(score, docidx)] sorted on descending score, {"accumulators": n, "skipped": n}), where
+        skipped counts the postings that did not get an accumulator.
+        """
+        terms = [self.bm25_term_scores(term) for term in query]
+        terms = sorted(terms, key=lambda item: len(item[0]))
+        # Suffix sums of the term maximum scores: the most a document without an accumulator can still get
+        max_scores = [float(scores.max()) if len(scores) else 0.0 for _, scores in terms]
+        remaining = np.cumsum(max_scores[::-1])[::-1]
+
+        accumulator = np.zeros(self.n_docs, dtype=np.float32)
+        has_accumulator = np.zeros(self.n_docs, dtype=bool)
+        stats = {"accumulators": 0, "skipped": 0}
+        new_accumulators = True
+        for i, (docs, scores) in enumerate(terms):
+            if maxscore and new_accumulators:
+                candidates = np.flatnonzero(has_accumulator)
+                if len(candidates) >= k:
+                    threshold = np.partition(accumulator[candidates], len(candidates) - k)[len(candidates) - k]
+                    new_accumulators = threshold <= remaining[i] * (1 + 1e-6)
+            if not new_accumulators:
+                keep = has_accumulator[docs]
+                stats["skipped"] += len(docs) - int(np.count_nonzero(keep))
+                docs, scores = docs[keep], scores[keep]
+            accumulator[docs] += scores
+            has_accumulator[docs] = True
+        candidates = np.flatnonzero(has_accumulator)
+        stats["accumulators"] = len(candidates)
+        return self.top_k(candidates, accumulator[candidates], k), stats
@@ -0,0 +1,183 @@
+import collections
+import heapq
+import json
+import math
+import os
+import shutil
+import numpy as np
+from progress.bar import Bar
+from binary_index import BinaryIndex, write_index
+from doc_table import DocTable, write_doc_table
+from engine import top_k
+
+FIELDS = ("title", "abstract", "body")
+FIELD_WEIGHTS = {"title": 2.0, "abstract": 1.0, "body": 0.5}
+
+RUN_ARRAYS = ("terms", "offsets", "docs", "tfs")
+
+def write_run(run_prefix, terms, docs, tfs):
+    """ Write the postings of a chunk of documents sorted on (term, doc) as .npy files that can be memory-mapped """
+    vocabulary, inverse = np.unique(np.asarray(terms, dtype=np.str_), return_inverse=True)
+    docs, tfs = np.asarray(docs, dtype=np.int32), np.asarray(tfs, dtype=np.int32)
+    order = np.lexsort((docs, inverse))
+    counts = np.bincount(inverse, minlength=len(vocabulary))
+    arrays = {"terms": vocabulary, "offsets": np.concatenate(([0], np.cumsum(counts))).astype(np.int64), "docs": docs[order], "tfs": tfs[order]}
+    for name in RUN_ARRAYS:
+        np.save("{0}.{1}.tmp.npy".format(run_prefix, name), arrays[name])
+        os.replace("{0}.{1}.tmp.npy".format(run_prefix, name), "{0}.{1}.npy".format(run_prefix, name))
+
+def merge_runs(run_prefixes):
+    """
+    Merge chunk runs into one sorted term list and a generator of the (docs, tfs) of every term. Chunks hold
+    increasing docidx ranges, so the postings of a term are the concatenation of its chunk postings. Runs are
+    memory-mapped and merged with a heap on their current term, only the postings of one term are in memory.
+    """
+    runs = [tuple(np.load("{0}.{1}.npy".format(prefix, name), mmap_mode="r") for name in RUN_ARRAYS) for prefix in run_prefixes]
+    # numpy and Python both sort str on code points, the same order as the utf-8 bytes the binary index needs
+    vocabulary = set()
+    for run_terms, _, _, _ in runs:
+        vocabulary.update(run_terms.tolist())
+    terms = sorted(vocabulary)
+    del vocabulary
+
+    def postings():
+        pointers = [0] * len(runs)
+        # Ties pop in run order, which keeps the docs of a term ascending
+        heap = [(str(run[0][0]), i) for i, run in enumerate(runs) if len(run[0])]
+        heapq.heapify(heap)
+        for term in terms:
+            docs, tfs = [], []
+            while heap and heap[0][0] == term:
+                _, i = heapq.heappop(heap)
+                run_terms, offsets, run_docs, run_tfs = runs[i]
+                p = pointers[i]
+                docs.append(run_docs[offsets[p]:offsets[p + 1]])
+                tfs.append(run_tfs[offsets[p]:offsets[p + 1]])
+                pointers[i] = p + 1
+                if p + 1 < len(run_terms):
+                    heapq.heappush(heap, (str(run_terms[p + 1]), i))
+            yield np.concatenate(docs), np.concatenate(tfs)
+    return terms, postings()
+
+def build_field_index(path, batches, analyze, checkpoint=None):
+    """
+    Build a field index from the (batch number, [(docid, {field: text})]) stream of ingest.ingest: every
+    batch is analyzed and written as a sorted run per field, afterwards the runs of every field are merged
+    into a BinaryIndex in path/<field>. The doc table in path/doctable maps docidx to docid. Runs of batches
+    that are already written are kept, so an interrupted build resumes with the ingest checkpoint, which is
+    removed once the index is complete.
+    """
+    runs_dir = os.path.join(path, "runs")
+    os.makedirs(runs_dir, exist_ok=True)
+    written = {int(name[len("docids-"):-len(".npy")]): os.path.join(runs_dir, name) for name in os.listdir(runs_dir)
+        if name.startswith("docids-") and not name.endswith(".tmp.npy")}
+    n_docs = None
+    bar = Bar("Indexing documents")
+    for batch_number, documents in batches:
+        if n_docs is None:
+            # A resumed build continues after the documents of the batches before it, later ones are stale
+            n_docs = sum(len(np.load(filename)) for number, filename in written.items() if number < batch_number)
+            for filename in (filename for number, filename in written.items() if number >= batch_number):
+                os.remove(filename)
+        # Docids of the batch are written last, they mark its runs as complete
+        docids_file = os.path.join(runs_dir, "docids-{0:09d}.npy".format(batch_number))
+        chunk = {field: ([], [], []) for field in FIELDS}
+        for i, (docid, fields) in enumerate(documents):
+            docidx = n_docs + i
+            for field in FIELDS:
+                terms, docs, tfs = chunk[field]
+                for term, tf in collections.Counter(analyze(fields.get(field) or "")).items():
+                    terms.append(term)
+                    docs.append(docidx)
+                    tfs.append(tf)
+            bar.next()
+        for field in FIELDS:
+            write_run(os.path.join(runs_dir, "{0}-{1:09d}".format(field, batch_number)), *chunk[field])
+        np.save(docids_file + ".tmp.npy", np.array([docid for docid, _ in documents], dtype=np.str_))
+        os.replace(docids_file + ".tmp.npy", docids_file)
+        n_docs += len(documents)
+    bar.finish()
+
+    # Batches hold consecutive docidx ranges, in the order of their numbers
+    docids_files = sorted(name for name in os.listdir(runs_dir) if name.startswith("docids-") and not name.endswith(".tmp.npy"))
+    batch_numbers = [name[len("docids-"):-len(".npy")] for name in docids_files]
+    docids = np.concatenate([np.load(os.path.join(runs_dir, name)) for name in docids_files] or [np.empty(0, dtype=np.str_)]).tolist()
+    lengths = np.zeros(len(docids), dtype=np.int64)
+    for field in FIELDS:
+        terms, postings = merge_runs([os.path.join(runs_dir, "{0}-{1}".format(field, number)) for number in batch_numbers])
+        bar = Bar("Writing {0} index".format(field), max=len(terms))
+        write_index(os.path.join(path, field), terms, postings, len(docids), forward=False, bar=bar)
+        bar.finish()
+        lengths += BinaryIndex(os.path.join(path, field)).doc_lengths
+    write_doc_table(os.path.join(path, "doctable"), docids, lengths)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"documents": len(docids), "fields": list(FIELDS)}, f)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    shutil.rmtree(runs_dir)
+
+def exists(path):
+    return os.path.exists(os.path.join(path, "meta.json"))
+
+def parse_weights(text):
+    """ Field weights from "title=2,abstract=1,body=0.5", fields that are left out keep their default weight """
+    weights = dict(FIELD_WEIGHTS)
+    for item in text.split(","):
+        field, _, weight = item.partition("=")
+        if field not in FIELDS:
+            raise ValueError("Unknown field {0}, fields are {1}".format(field, ", ".join(FIELDS)))
+        weights[field] = float(weight)
+    return weights
+
+class BM25F:
+    """
+    BM25F over a field index: the tf of a term in every field is normalized on the length of that field and
+    weighted, the weighted sum is saturated once with k1. Fields with weight 0 are not read at all.
+    """
+
+    def __init__(self, path, weights=FIELD_WEIGHTS, k1=0.9, b=0.4):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.doc_table = DocTable(os.path.join(path, "doctable"))
+        self.n_docs = self.meta["documents"]
+        self.k1 = k1
+        self.fields = {}
+        for field in self.meta["fields"]:
+            if weights.get(field, 0) == 0:
+                continue
+            index = BinaryIndex(os.path.join(path, field))
+            stats = index.stats()
+            lengths = np.asarray(index.doc_lengths, dtype=np.float32)
+            avgdl = stats["total_terms"] / max(stats["non_empty_documents"], 1)
+            # weight / (1 - b + b * dl / avgdl), what a tf in this field is multiplied with
+            self.fields[field] = (index, (weights[field] / (1 - b + b * lengths / avgdl)).astype(np.float32))
+
+    def idf(self, df):
+        return math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+
+    def term_scores(self, term):
+        """ BM25F weight of term for every document that has it in a weighted field, as (docs, scores) """
+        docs_list, tfs_list = [], []
+        for index, scaling in self.fields.values():
+            postings = index.get_postings(term)
+            if postings is not None:
+                docs_list.append(postings[0])
+                tfs_list.append(postings[1] * scaling[postings[0]])
+        if not docs_list:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        docs, inverse = np.unique(np.concatenate(docs_list), return_inverse=True)
+        tfs = np.bincount(inverse, weights=np.concatenate(tfs_list))
+        return docs, (self.idf(len(docs)) * tfs / (self.k1 + tfs)).astype(np.float32)
+
+    def score_query(self, query, k):
+        """ Top-k of an analyzed query as [(score, docidx)] sorted on descending score """
+        accumulator = np.zeros(self.n_docs, dtype=np.float32)
+        docs_list = []
+        for term in query:
+            docs, scores = self.term_scores(term)
+            accumulator[docs] += scores
+            docs_list.append(docs)
+        if not docs_list:
+            return []
+        candidates = np.unique(np.concatenate(docs_list))
+        return top_k(candidates, accumulator[candidates], k)
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import numpy as np
+from progress.bar import Bar
+import binary_index
+from binary_index import BinaryIndex, TermDictionary
+from engine import PostingsEngine, top_k
+
+def build_impact_index(path, binary_index_path, k1=0.9, b=0.4, bits=8):
+    """
+    Precompute the BM25 score of every posting in a binary index for (k1, b), quantize the scores to
+    bits-bit integer impacts and store the postings of every term in segments of equal impact, highest
+    impact first. Within a segment the docs are sorted on docidx.
+    """
+    index = BinaryIndex(binary_index_path)
+    engine = PostingsEngine(None, index.doc_lengths, k1=k1, b=b, binary_index=index)
+    levels = 2 ** bits - 1
+    # One pass over the forward index gives the highest score in the collection, the top of the scale
+    idf = np.array([engine.idf(df) for df in index.df])
+    row_docs = np.repeat(np.arange(index.num_docs()), np.diff(index.fwd_indptr))
+    tfs = np.asarray(index.fwd_tfs, dtype=np.float64)
+    max_score = float(np.max(idf[index.fwd_terms] * tfs / (tfs + engine.norms[row_docs]), initial=0.0)) or 1.0
+    scale = max_score / levels
+
+    os.makedirs(path, exist_ok=True)
+    for filename in ("terms.bin", "term_offsets.npy"):
+        shutil.copyfile(os.path.join(binary_index_path, filename), os.path.join(path, filename))
+
+    term_segments = [0]
+    segment_impacts = []
+    segment_offsets = [0]
+    all_docs = []
+    bar = Bar("Building impact index", max=len(index.terms))
+    for term_id in range(len(index.terms)):
+        docs, tfs = index.get_postings_by_id(term_id)
+        tfs = tfs.astype(np.float32)
+        scores = idf[term_id] * tfs / (tfs + engine.norms[docs])
+        # Every posting keeps at least impact 1, so quantization never drops a document
+        impacts = np.clip(np.floor(scores / scale + 0.5), 1, levels).astype(np.uint8)
+        order = np.lexsort((docs, -impacts.astype(np.int16)))
+        docs, impacts = docs[order], impacts[order]
+        starts = np.flatnonzero(np.concatenate(([len(docs) > 0], impacts[1:] != impacts[:-1])))
+        segment_impacts.append(impacts[starts])
+        segment_offsets.extend((np.append(starts[1:], len(docs)) + segment_offsets[-1]).tolist())
+        term_segments.append(term_segments[-1] + len(starts))
+        all_docs.append(docs)
+        bar.next()
+    bar.finish()
+
+    np.save(os.path.join(path, "term_segments.npy"), np.asarray(term_segments, dtype=np.int64))
+    np.save(os.path.join(path, "segment_impacts.npy"), np.concatenate(segment_impacts or [[]]).astype(np.uint8))
+    np.save(os.path.join(path, "segment_offsets.npy"), np.asarray(segment_offsets, dtype=np.int64))
+    np.save(os.path.join(path, "docs.npy"), np.concatenate(all_docs or [[]]).astype(np.int32))
+    meta = {"documents": index.num_docs(), "k1": k1, "b": b, "bits": bits, "scale": scale, "binary_index": binary_index_path,
+        "index": binary_index.fingerprint(binary_index_path)}
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+def exists(path, k1=None, b=None, binary_index_path=None):
+    """ Whether an impact index is built at path, for (k1, b) and from the current binary index if they are given """
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return False
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if binary_index_path is not None and meta.get("index") != binary_index.fingerprint(binary_index_path):
+        return False
+    return (k1 is None or meta["k1"] == k1) and (b is None or meta["b"] == b)
+
+class ImpactIndex:
+    """
+    Memory-mapped impact-ordered index, queried score-at-a-time: the segments of all query terms are
+    processed from highest to lowest impact, so the most important postings are read first and scoring can
+    stop after any number of postings.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.terms = TermDictionary(path)
+        self.scale = self.meta["scale"]
+        self.n_docs = self.meta["documents"]
+        self.term_segments = np.load(os.path.join(path, "term_segments.npy"), mmap_mode="r")
+        self.segment_impacts = np.load(os.path.join(path, "segment_impacts.npy"), mmap_mode="r")
+        self.segment_offsets = np.load(os.path.join(path, "segment_offsets.npy"), mmap_mode="r")
+        self.docs = np.load(os.path.join(path, "docs.npy"), mmap_mode="r")
+
+    def get_segments(self, term):
+        """ [(impact, docs)] of an analyzed term in descending impact order, empty if the term is not in the index """
+        term_id = self.terms.lookup(term)
+        if term_id < 0:
+            return []
+        first, last = self.term_segments[term_id], self.term_segments[term_id + 1]
+        return [(int(self.segment_impacts[s]), self.docs[self.segment_offsets[s]:self.segment_offsets[s + 1]])
+            for s in range(first, last)]
+
+    def score_query(self, query, k, budget=None):
+        """
+        Score-at-a-time retrieval of an analyzed query. With a budget at most that many postings are read,
+        the segment that crosses the budget is cut off. Scores are the summed impacts scaled back to BM25.
+
+        Returns ([(score, docidx)] sorted on descending score, {"postings": n, "skipped": n}), where
+        skipped counts the postings left unread because of the budget.
+        """
+        segments = [segment for term in query for segment in self.get_segments(term)]
+        # Stable sort, segments of equal impact keep the query term order
+        segments.sort(key=lambda segment: -segment[0])
+        accumulator = np.zeros(self.n_docs, dtype=np.int32)
+        touched = np.zeros(self.n_docs, dtype=bool)
+        stats = {"postings": 0, "skipped": 0}
+        for impact, docs in segments:
+            if budget is not None and stats["postings"] + len(docs) > budget:
+                stats["skipped"] += len(docs)
+                docs = docs[:max(budget - stats["postings"], 0)]
+                stats["skipped"] -= len(docs)
+            accumulator[docs] += impact
+            touched[docs] = True
+            stats["postings"] += len(docs)
+        candidates = np.flatnonzero(touched)
+        if len(candidates) == 0:
+            return [], stats
+        return top_k(candidates, accumulator[candidates] * self.scale, k), stats
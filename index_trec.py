@@ -1,71 +1,127 @@
+import bisect
 import itertools
 import math
+import numpy as np
+import instrumentation
+
+SKIP_BLOCK_SIZE = 128
 
 class InvertedList:
-    def __init__(self, pointer, term, ilist):
+    """
+    Postings of one term as parallel docs/tfs arrays with a pointer to the current posting.
+    Skipping uses per-block skip pointers (the last doc of every block) followed by a binary search
+    inside the block, without skip pointers it gallops from the current position.
+    If the scores of all postings are given, the list also keeps the maximum score of the whole list
+    and of every block, which are the upper bounds used by WAND and BlockMax-WAND. The per-block arrays are
+    kept as Python lists, they are read one item at a time and numpy scalar access costs more than the lookup.
+    """
+
+    def __init__(self, term, docs, tfs, pointer=0, block_size=SKIP_BLOCK_SIZE, scores=None):
         self.pointer = pointer
         self.term = term
-        self.ilist = ilist
+        self.docs = np.asarray(docs, dtype=np.int32)
+        self.tfs = np.asarray(tfs, dtype=np.int32)
+        self.block_size = block_size
+        if block_size:
+            self.block_last_doc = self.docs[np.minimum(np.arange(block_size, len(self.docs) + block_size, block_size), len(self.docs)) - 1].tolist()
+        self.scores = scores
+        if scores is not None:
+            self.scores = np.asarray(scores, dtype=np.float64)
+            self.max_score = float(self.scores.max()) if len(self.scores) else 0.0
+            if block_size and len(self.scores):
+                self.block_max_score = np.maximum.reduceat(self.scores, np.arange(0, len(self.scores), block_size)).tolist()
 
     def __repr__(self):
-        return "(pointer: {0}, term: {1}, ilist_len: {2})".format(self.pointer, self.term, len(self.ilist))
+        return "(pointer: {0}, term: {1}, ilist_len: {2})".format(self.pointer, self.term, len(self.docs))
 
 
     def get_item(self):
         # If list is either empty or finished
-        if not self.ilist or self.is_finished():
-            # print("length of list " + str(len(self.ilist)))
-            # print("is finished " + str(self.is_finished))
+        if self.is_finished():
             return ()
-        return self.ilist[self.pointer]
+        return int(self.docs[self.pointer]), int(self.tfs[self.pointer])
 
     def increment(self):
         self.pointer += 1
 
     def get_list_len(self):
-        return len(self.ilist)
+        return len(self.docs)
 
     def get_term(self):
         return self.term
 
     def is_finished(self):
-        return self.pointer >= (len(self.ilist))
+        return self.pointer >= len(self.docs)
 
     def get_current_doc(self):
-        if not self.get_item():
+        if self.is_finished():
             return None
-        else:
-            return self.get_item()[0]
+        return int(self.docs[self.pointer])
 
     def get_current_tf(self):
-        if not self.get_item():
+        if self.is_finished():
             return None
+        return int(self.tfs[self.pointer])
+
+    def get_current_score(self):
+        if self.is_finished():
+            return None
+        return float(self.scores[self.pointer])
+
+    def get_block(self, docidx):
+        """ Index of the block that holds the first posting >= docidx, without moving the pointer """
+        block = self.pointer // self.block_size
+        # Most lookups land in the current block, the others search the skip pointers after it
+        if block < len(self.block_last_doc) and self.block_last_doc[block] >= docidx:
+            return block
+        return bisect.bisect_left(self.block_last_doc, docidx, block + 1)
+
+    def get_block_max(self, docidx):
+        """ (upper bound on the score of docidx, last doc the bound holds for) from the block skip pointers """
+        block = self.get_block(docidx)
+        if block >= len(self.block_last_doc):
+            return 0.0, None
+        return self.block_max_score[block], self.block_last_doc[block]
+
+    def next_geq(self, docidx):
+        """ Move the pointer forward to the first posting with doc >= docidx and return the new position """
+        if self.is_finished() or self.docs[self.pointer] >= docidx:
+            return self.pointer
+        if self.block_size:
+            block = self.get_block(docidx)
+            lo = min(max(self.pointer, block * self.block_size), len(self.docs))
+            hi = min(lo + self.block_size, len(self.docs))
         else:
-            return self.get_item()[1]
+            # Galloping: double the step until we pass docidx, then binary search the last step
+            lo, step = self.pointer, 1
+            hi = lo + step
+            while hi < len(self.docs) and self.docs[hi] < docidx:
+                lo = hi
+                step *= 2
+                hi = lo + step
+            hi = min(hi + 1, len(self.docs))
+        self.pointer = lo + int(np.searchsorted(self.docs[lo:hi], docidx))
+        return self.pointer
 
     def incremental_skip_forward_to_document(self, docidx):
-        original_index = self.pointer
-        finished = self.is_finished()
-        found = self.get_current_doc() == docidx
-        while(not finished and not found):
-            self.increment()
-            finished = self.is_finished()
-            found = self.get_current_doc() == docidx
-        if not found:
-            self.pointer = original_index
+        self.skip_forward_to_document(docidx)
 
     def skip_forward_to_document(self, docidx):
-        mappedList = list(map(lambda x : x[0], self.ilist[self.pointer:]))
-        if docidx in mappedList:
-            new_index = mappedList.index((docidx)) + self.pointer
-            assert new_index >= self.pointer
-            self.pointer = new_index
+        """ Move the pointer to docidx if the list contains it, otherwise leave it where it is """
+        original_index = self.pointer
+        self.next_geq(docidx)
+        if self.get_current_doc() != docidx:
+            self.pointer = original_index
 
 class Index:
 
-    def __init__(self, index, searcher):
+    def __init__(self, index, searcher, binary_index=None, doc_cache=None):
         self.index_reader = index
         self.searcher = searcher
+        # Optional BinaryIndex, serves postings and document lengths without going through the JVM
+        self.binary_index = binary_index
+        # Optional DocumentVectorCache shared with Models
+        self.doc_cache = doc_cache
 
     def get_external_docid(self, internal_docid):
         return self.index_reader.convert_internal_docid_to_collection_docid(internal_docid)
@@ -82,23 +138,51 @@ class Index:
 
     def get_n_of_words_in_inverted_list_doc(self, doc):
         """ Hacky: Sum all term frequencies in document vector (thus no stopwords) """
+        if self.doc_cache is not None:
+            return self.doc_cache.get_length(doc)
+        if self.binary_index is not None:
+            return self.binary_index.get_doc_length(doc)
         return sum(self.index_reader.get_document_vector(self.get_docid_from_index(doc)).values())
 
     def get_inverted_list(self, term):
-        print(term)
+        instrumentation.count("index.inverted_lists")
+        if self.binary_index is not None:
+            postings = self.binary_index.get_postings(term)
+            if postings is None:
+                return InvertedList(term, [], [])
+            return InvertedList(term, postings[0], postings[1])
         postings = self.index_reader.get_postings_list(term, analyzer=None)
-        print(postings is None)
         if postings is None:
-            return InvertedList(0, term, [])
+            return InvertedList(term, [], [])
         else:
-            # [(term, (index_docid, tf))]
-            return InvertedList(0, term, sorted([(posting.docid, posting.tf) for posting in postings], key=lambda item: item[0]))
-            # return [(term, (posting.docid, posting.tf)) for posting in postings]
+            postings = sorted([(posting.docid, posting.tf) for posting in postings], key=lambda item: item[0])
+            return InvertedList(term, [doc for doc, _ in postings], [tf for _, tf in postings])
 
 
-    def get_docids_from_postings(self, term, docidx_docid, return_set = set(), max_doc=192459, debug=True):
+    def get_postings_docidx(self, term):
+        """ Sorted int32 docidx of the documents containing term """
+        if self.binary_index is not None:
+            postings = self.binary_index.get_postings(term)
+            return postings[0] if postings is not None else np.empty(0, dtype=np.int32)
+        postings = self.index_reader.get_postings_list(term, analyzer=None)
+        if postings is None:
+            return np.empty(0, dtype=np.int32)
+        return np.sort(np.fromiter((posting.docid for posting in postings), dtype=np.int32, count=len(postings)))
+
+    def get_candidates(self, query):
+        """ Sorted, deduplicated int32 docidx of all documents that contain a query term """
+        lists = [self.get_postings_docidx(term) for term in query]
+        instrumentation.count("candidates.postings", sum(len(docs) for docs in lists))
+        if not lists:
+            return np.empty(0, dtype=np.int32)
+        # One sort of all postings is the union of the sorted lists
+        return np.unique(np.concatenate(lists))
+
+    def get_docids_from_postings(self, term, docidx_docid, return_set=None, max_doc=192459, debug=False):
         """ Use postings and set union to get list of documents containing query words """
         if debug:
+            if return_set is None:
+                return_set = set()
             try:
                 postings = self.index_reader.get_postings_list(term, analyzer=None)
             except:
@@ -113,6 +197,11 @@ class Index:
                     except:
                         continue
             return return_set
+        if self.binary_index is not None:
+            postings = self.binary_index.get_postings(term)
+            if postings is None:
+                return []
+            return [docidx_docid[docidx][0] for docidx in postings[0].tolist()]
         try:
             return [docidx_docid[posting.docid][0] for posting in self.index_reader.get_postings_list(term, analyzer=None) if posting is not None]
         except:
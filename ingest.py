@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+CHECKPOINT_VERSION = 1
+
+def metadata_fingerprint(metadata_file):
+    """ Hash of the path, size and modification time of metadata.csv, a checkpoint of another file is not resumed """
+    stat = os.stat(metadata_file)
+    key = "{0}\0{1}\0{2}".format(os.path.abspath(metadata_file), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def read_metadata(metadata_file):
+    """ Stream the rows of metadata.csv as (row number, cord_uid, title, abstract, pdf_json_files) """
+    # Abstracts of a few papers are larger than the default field limit
+    csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+    with open(metadata_file, encoding="utf-8", newline="") as f:
+        for row_number, row in enumerate(csv.DictReader(f)):
+            yield row_number, row["cord_uid"], row["title"], row["abstract"], row["pdf_json_files"]
+
+def parse_full_text(json_paths, data_dir):
+    """
+    (introduction, body, bytes read, unreadable files) from the first parsed full text of a paper that
+    exists on disk and can be read. The introduction holds the paragraphs of sections named intro*, the
+    body every paragraph. A file that cannot be read or parsed is reported and the next one is tried.
+    """
+    errors = 0
+    for json_path in json_paths.split("; ") if json_paths else []:
+        full_path = os.path.join(data_dir, json_path)
+        if os.path.exists(full_path):
+            try:
+                with open(full_path, "rb") as f:
+                    data = f.read()
+                paragraphs = json.loads(data)["body_text"]
+                introduction = [p["text"] for p in paragraphs if "intro" in p.get("section", "").lower()]
+                return introduction, [p["text"] for p in paragraphs], len(data), errors
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                # ValueError covers json.JSONDecodeError and invalid utf-8, the others a malformed document
+                print("Skipping full text {0}: {1!r}".format(full_path, e), file=sys.stderr)
+                errors += 1
+    return [], [], 0, errors
+
+def parse_batch(rows, data_dir, full_text=True):
+    """ Documents of a batch of metadata rows as (cord_uid, {field: text}), plus the counts of the batch """
+    documents = []
+    counts = collections.Counter()
+    for cord_uid, title, abstract, json_paths in rows:
+        introduction, body, n_bytes, errors = parse_full_text(json_paths, data_dir) if full_text else ([], [], 0, 0)
+        counts["full_texts"] += 1 if n_bytes else 0
+        counts["json_bytes"] += n_bytes
+        counts["json_errors"] += errors
+        documents.append((cord_uid, {"title": title, "abstract": abstract, "introduction": "\n".join(introduction),
+            "body": "\n".join(body)}))
+    return documents, counts
+
+def load_checkpoint(checkpoint, fingerprint, batch_size):
+    """ (batches, rows) done according to the checkpoint file, (0, 0) if there is none for this metadata.csv """
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return 0, 0
+    with open(checkpoint) as f:
+        state = json.load(f)
+    if (state.get("version"), state.get("fingerprint"), state.get("batch_size")) != (CHECKPOINT_VERSION, fingerprint, batch_size):
+        return 0, 0
+    return state["batches"], state["rows"]
+
+def save_checkpoint(checkpoint, fingerprint, batch_size, batches, rows):
+    tmp_file = checkpoint + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"version": CHECKPOINT_VERSION, "fingerprint": fingerprint, "batch_size": batch_size, "batches": batches,
+            "rows": rows}, f)
+    os.replace(tmp_file, checkpoint)
+
+def ingest(metadata_file, data_dir=None, batch_size=1000, workers=None, full_text=True, checkpoint=None, stats=None):
+    """
+    Stream the documents of a CORD-19 release as (batch number, [(cord_uid, {field: text})]). Fields are
+    title, abstract, introduction and body, full texts are read from the pdf_json_files relative to data_dir
+    (the directory of metadata.csv by default). A cord_uid is only read from its first row.
+
+    Full texts are parsed by a pool of workers, at most two batches per worker are in flight, so memory is
+    bounded by the batch size and not by the size of the release. Every batch except the last one holds
+    batch_size documents. With checkpoint, a batch counts as done once the consumer asks for the next one,
+    and a later call resumes after the last batch that was done. stats is updated with the counters.
+    """
+    data_dir = data_dir if data_dir is not None else os.path.dirname(metadata_file)
+    workers = workers or os.cpu_count()
+    stats = stats if stats is not None else {}
+    stats.update(rows=0, documents=0, duplicates=0, full_texts=0, json_bytes=0, json_errors=0, batches=0, seconds=0.0)
+    fingerprint = metadata_fingerprint(metadata_file)
+    done_batches, done_rows = load_checkpoint(checkpoint, fingerprint, batch_size)
+    stats["resumed_batches"] = done_batches
+
+    def batches():
+        """ Metadata rows in batches of batch_size unique documents, with the number of rows read so far """
+        seen = set()
+        batch = []
+        for row_number, cord_uid, title, abstract, json_paths in read_metadata(metadata_file):
+            stats["rows"] += 1
+            if cord_uid in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(cord_uid)
+            # Rows of finished batches only fill seen, their full texts are not read again
+            if row_number < done_rows:
+                continue
+            batch.append((cord_uid, title, abstract, json_paths))
+            if len(batch) == batch_size:
+                yield batch, row_number + 1
+                batch = []
+        if batch:
+            yield batch, stats["rows"]
+
+    start = time.perf_counter()
+    pending = collections.deque()
+    batch_number = done_batches
+    # spawn, the parent process may run a JVM which does not survive a fork
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        rows = batches()
+        while True:
+            while len(pending) < 2 * workers:
+                batch = next(rows, None)
+                if batch is None:
+                    break
+                pending.append((pool.submit(parse_batch, batch[0], data_dir, full_text), batch[1]))
+            if not pending:
+                break
+            future, rows_read = pending.popleft()
+            documents, counts = future.result()
+            stats["documents"] += len(documents)
+            stats["full_texts"] += counts["full_texts"]
+            stats["json_bytes"] += counts["json_bytes"]
+            stats["json_errors"] += counts["json_errors"]
+            stats["batches"] += 1
+            stats["seconds"] = time.perf_counter() - start
+            yield batch_number, documents
+            batch_number += 1
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, fingerprint, batch_size, batch_number, rows_read)
+
+def throughput(stats):
+    """ One line summary of the counters of an ingest """
+    seconds = max(stats["seconds"], 1e-9)
+    summary = "{0} documents ({1} full texts) from {2} rows in {3:.1f}s, {4:.0f} docs/s, {5:.1f} MB/s of JSON".format(
+        stats["documents"], stats["full_texts"], stats["rows"], stats["seconds"], stats["documents"] / seconds,
+        stats["json_bytes"] / seconds / 1e6)
+    if stats["json_errors"]:
+        summary += ", {0} unreadable JSON files skipped".format(stats["json_errors"])
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a CORD-19 release and report the ingestion throughput")
+    parser.add_argument("metadata", help="Path of metadata.csv")
+    parser.add_argument("--data_dir", help="Directory the pdf_json_files are relative to, by default the one of metadata.csv", default=None)
+    parser.add_argument("--batch_size", help="Number of documents per batch", type=int, default=1000)
+    parser.add_argument("-w", "--workers", help="Number of processes parsing full texts", type=int, default=None)
+    parser.add_argument("--no_full_text", dest="full_text", help="Only read the metadata", action="store_false", default=True)
+    parser.add_argument("-c", "--checkpoint", help="Resume from and record progress in this file", default=None)
+    args = parser.parse_args()
+
+    stats = {}
+    for batch_number, _ in ingest(args.metadata, data_dir=args.data_dir, batch_size=args.batch_size, workers=args.workers,
+            full_text=args.full_text, checkpoint=args.checkpoint, stats=stats):
+        print("Batch {0}: {1}".format(batch_number, throughput(stats)))
+    print(throughput(stats))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+class _NullSpan:
+    """ What span() hands out while instrumentation is disabled, entering and leaving it does nothing """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        stack = self.recorder.stack()
+        self.depth = len(stack)
+        stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.recorder.stack().pop()
+        self.recorder.add_span(self.name, self.start, end, self.depth, self.args)
+        return False
+
+class Recorder:
+    """
+    Collects spans, counters and notes. Span durations and counters are summed per name for the whole run
+    and for the query that is being ranked, every span is also kept as a trace event if trace is set.
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = {}
+        self.counters = {}
+        self.queries = {}
+        self.query = None
+        self.events = []
+
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def add_span(self, name, start, end, depth, args):
+        duration = end - start
+        with self.lock:
+            for totals in (self.spans, self.query["spans"]) if self.query is not None else (self.spans,):
+                total = totals.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+                total["count"] += 1
+                total["total_ms"] += duration * 1000
+                total["max_ms"] = max(total["max_ms"], duration * 1000)
+            if self.trace:
+                event = {"name": name, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": duration * 1e6,
+                    "pid": os.getpid(), "tid": threading.get_ident(), "args": dict(args, depth=depth)}
+                self.events.append(event)
+
+    def add_count(self, name, n):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            if self.query is not None:
+                self.query["counters"][name] = self.query["counters"].get(name, 0) + n
+
+    def add_note(self, name, args):
+        if self.trace:
+            with self.lock:
+                self.events.append({"name": name, "ph": "i", "s": "t", "ts": (time.perf_counter() - self.origin) * 1e6,
+                    "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+    def summary(self):
+        return {"spans": self.spans, "counters": self.counters, "queries": self.queries}
+
+_recorder = None
+
+def enable(trace=False):
+    """ Start recording, with trace every single span is kept for export_chrome_trace """
+    global _recorder
+    _recorder = Recorder(trace=trace)
+    return _recorder
+
+def disable():
+    global _recorder
+    _recorder = None
+
+def enabled():
+    return _recorder is not None
+
+def span(name, **args):
+    """ Context manager timing a named block, spans nest """
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, name, args)
+
+def traced(name):
+    """ Decorator that runs every call of the function in a span """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _Span(_recorder, name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    """ Add n to a named counter """
+    if _recorder is not None:
+        _recorder.add_count(name, n)
+
+def note(name, **args):
+    """ Instant event with some values attached, only kept in the trace """
+    if _recorder is not None:
+        _recorder.add_note(name, args)
+
+@contextlib.contextmanager
+def query(query_id):
+    """ Context manager that also sums the spans and counters inside it per query id """
+    if _recorder is None:
+        yield
+        return
+    _recorder.query = _recorder.queries.setdefault(str(query_id), {"spans": {}, "counters": {}})
+    try:
+        yield
+    finally:
+        _recorder.query = None
+
+class CountingProxy:
+    """ Wraps an object and counts the calls of each of its methods as counter prefix + method name """
+
+    def __init__(self, wrapped, prefix="jvm."):
+        self._wrapped = wrapped
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self._wrapped, name)
+        if not callable(attribute):
+            return attribute
+        counter = self._prefix + name
+
+        def call(*args, **kwargs):
+            count(counter)
+            return attribute(*args, **kwargs)
+        return call
+
+def export_json(filename):
+    """ Write the summed spans and counters of the run and of every query """
+    with open(filename, "w") as f:
+        json.dump(_recorder.summary() if _recorder is not None else {}, f, indent=2)
+
+def export_chrome_trace(filename):
+    """ Write the recorded spans in the Chrome trace event format, for chrome://tracing or Perfetto """
+    events = list(_recorder.events) if _recorder is not None else []
+    if _recorder is not None:
+        events.extend({"name": name, "ph": "C", "ts": (time.perf_counter() - _recorder.origin) * 1e6, "pid": os.getpid(),
+            "args": {"value": value}} for name, value in _recorder.counters.items())
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
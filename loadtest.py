@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+import topics
+
+TOPICSFILE = "input/topics-rnd5.xml"
+
+def read_queries(topicsfile):
+    """ (topic number, query) of every topic in a TREC topics file """
+    return [(int(number), topic["query"]) for number, topic in topics.parse_topics(topicsfile).items()]
+
+async def post(path, payload, host="127.0.0.1", port=8000, unix_socket=None):
+    """ POST payload as JSON to the server, returns (status, decoded response) """
+    if unix_socket is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode("utf-8")
+    writer.write("POST {0} HTTP/1.1\r\nHost: {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n\r\n".format(
+        path, host, len(body)).encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    # The server closes the connection after every response
+    response = (await reader.read()).split(b"\r\n\r\n", 1)[1]
+    writer.close()
+    return status, json.loads(response)
+
+async def run_load(requests, concurrency, host, port, unix_socket):
+    """ Send all requests with at most concurrency in flight, returns [(status, latency in seconds)] """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(payload):
+        async with semaphore:
+            start = time.perf_counter()
+            status, _ = await post("/search", payload, host, port, unix_socket)
+            return status, time.perf_counter() - start
+
+    return await asyncio.gather(*(timed(payload) for payload in requests))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test client for server.py")
+    parser.add_argument("--host", help="Address of the server", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="Port of the server", type=int, default=8000)
+    parser.add_argument("-u", "--unix_socket", help="Connect to this Unix socket instead of TCP", default=None)
+    parser.add_argument("-n", "--n_requests", help="Number of requests to send, cycling through the topics", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", help="Number of requests in flight at once", type=int, default=4)
+    parser.add_argument("-m", "--model", help="Model of every request", default="bm25")
+    parser.add_argument("-k", "--k_docs", help="Number of documents to retrieve", type=int, default=100)
+    parser.add_argument("-r", "--rerank", help="Rerank model of every request", default="none")
+    args = parser.parse_args()
+
+    queries = read_queries(TOPICSFILE)
+    requests = [{"query": query, "topic": topic, "model": args.model, "k": args.k_docs, "rerank": args.rerank}
+        for topic, query in (queries[i % len(queries)] for i in range(args.n_requests))]
+    start = time.perf_counter()
+    results = asyncio.run(run_load(requests, args.concurrency, args.host, args.port, args.unix_socket))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for status, latency in results if status == 200]) * 1000
+    failed = sum(1 for status, _ in results if status != 200)
+    print("{0} requests in {1:.2f}s ({2:.1f} QPS), {3} failed".format(len(results), elapsed, len(results) / elapsed, failed))
+    if len(latencies):
+        print("latency ms: p50 {0:.1f}  p90 {1:.1f}  p99 {2:.1f}  max {3:.1f}".format(
+            *np.percentile(latencies, [50, 90, 99]), latencies.max()))
+
+if __name__ == "__main__":
+    main()
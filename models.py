@@ -1,39 +1,97 @@
 import itertools
 import math
-import pandas as pd
-import collections
 from index_trec import Index
 import numpy as np
-from timer import Timer
-from tqdm import tqdm
+import scipy.sparse as sp
+import instrumentation
+from qrels import load_qrels
 
 class Models:
 
-    def __init__(self, index, qrelfile):
+    def __init__(self, index, qrelfile, binary_index=None, doc_table=None, term_stats=None, doc_cache=None, doc_vectors=None):
         self.index_reader = index
-        self.N = self.index_reader.stats()['documents']
-        self.t = Timer()
+        # Optional BinaryIndex, serves document vectors and term counts without going through the JVM
+        self.binary_index = binary_index
+        # Optional DocTable, resolves external docids to docidx without going through the JVM
+        self.doc_table = doc_table
+        # Optional TermStats, df/idf table that replaces the per-query df_vector and get_term_counts calls
+        self.term_stats = term_stats
+        # Optional DocumentVectorCache shared with Index, so a document vector is only fetched once
+        self.doc_cache = doc_cache
+        # Optional DocumentVectors, precomputed tf-idf rows keyed on the term ids of term_stats
+        self.doc_vectors = doc_vectors
+        self.N = (self.index_reader if self.binary_index is None else self.binary_index).stats()['documents']
 
         self.qrelfile = qrelfile
+        self.qrels = load_qrels(qrelfile)
         self.df_vector = {}
 
-        # global variables for rocchio algorithm
-        # so that we only need to compute the document vectors once
-        # and only need to adjust the query vector for the new query
-        self.c_list = []
-        self.relevance_data = None
-        self.all_docs= []
-        self.top_k_doc_vec = {}
-        self.complete_query_vector = []
+    def get_docidx(self, docid):
+        if self.doc_table is not None:
+            return self.doc_table.docidx(docid)
+        return self.index_reader.convert_collection_docid_to_internal_docid(docid)
+
+    def indexed_docidx(self, docid):
+        """ docidx of a docid that has to be in the index, a KeyError instead of the -1 of get_docidx """
+        docidx = self.get_docidx(docid)
+        if docidx < 0:
+            raise KeyError("docid {0} is not in the index".format(docid))
+        return docidx
+
+    def get_docid(self, docidx):
+        if self.doc_table is not None:
+            return self.doc_table.docid(docidx)
+        return self.index_reader.convert_internal_docid_to_collection_docid(docidx)
+
+    def get_document_vector_by_docidx(self, docidx):
+        if self.doc_cache is not None:
+            return self.doc_cache.get_vector(docidx)
+        if self.binary_index is not None:
+            return self.binary_index.get_document_vector(docidx)
+        return self.index_reader.get_document_vector(self.get_docid(docidx))
+
+    def get_n_of_words_by_docidx(self, docidx):
+        if self.doc_cache is not None:
+            return self.doc_cache.get_length(docidx)
+        if self.binary_index is not None:
+            return self.binary_index.get_doc_length(docidx)
+        return sum(self.get_document_vector_by_docidx(docidx).values())
+
+    def get_document_vector(self, docid):
+        if self.doc_cache is not None:
+            return self.doc_cache.get_vector(self.indexed_docidx(docid))
+        if self.binary_index is not None:
+            return self.binary_index.get_document_vector(self.indexed_docidx(docid))
+        return self.index_reader.get_document_vector(docid)
+
+    def get_df(self, term):
+        if self.term_stats is not None:
+            return self.term_stats.df(term)
+        if self.binary_index is not None:
+            return self.binary_index.get_term_counts(term)[0]
+        return self.index_reader.get_term_counts(term, analyzer=None)[0]
+
+    def get_idf(self, term):
+        """ log(N / (df + 1)), from the term stats table or from the df_vector of the current query """
+        if self.term_stats is not None:
+            return self.term_stats.idf(term)
+        if term not in self.df_vector:
+            self.compute_df_vector(term)
+        return math.log(self.N / (self.df_vector[term] + 1))
 
     def compute_df_vector(self, term):
-        self.df_vector[term] = self.index_reader.get_term_counts(term, analyzer=None)[0]
+        if self.term_stats is None:
+            self.df_vector[term] = self.get_df(term)
 
     def reset_df_vector(self):
         self.df_vector = {}
 
     def get_n_of_words_in_docid(self, docid):
         """ Hacky: Sum all term frequencies in document vector (thus no stopwords) """
+        if self.doc_cache is not None:
+            return self.doc_cache.get_length(self.indexed_docidx(docid))
+        if self.binary_index is not None:
+            return self.binary_index.get_doc_length(self.indexed_docidx(docid))
         return sum(self.index_reader.get_document_vector(docid).values())
 
     def docid_length(self, docid):
@@ -56,33 +114,41 @@ class Models:
         try:
             # Might throw keyerror, then return 0.0 (doesn't exist)
             if tfs is None:
-                tfs = self.index_reader.get_document_vector(docid)
+                tfs = self.get_document_vector(docid)
             if wordcount is None:
                 wordcount = self.get_n_of_words_in_docid(docid)
             tf = tfs[term] / wordcount
             if use_vector:
-                df = self.df_vector[term]
+                idf = self.get_idf(term)
             else:
-                df = self.index_reader.get_term_counts(term, analyzer=None)[0]
-            return tf * math.log(self.N / (df + 1))
+                idf = math.log(self.N / (self.get_df(term) + 1))
+            return tf * idf
         except KeyError:
             return 0.0
 
     def tf_idf_docid(self, docid, wordcount=None) -> {}:
-        tfs = self.index_reader.get_document_vector(docid)
+        if self.doc_vectors is not None:
+            term_ids, weights = self.doc_vectors.get_row(self.indexed_docidx(docid))
+            return {self.term_stats[int(t)]: float(w) for t, w in zip(term_ids, weights)}
+        tfs = self.get_document_vector(docid)
         tf_idf = {}
         if wordcount is None:
             wordcount = self.get_n_of_words_in_docid(docid)
         for term, count in tfs.items():
-            df = self.index_reader.get_term_counts(term, analyzer=None)[0]
-            tf_idf[term] = (count / wordcount) * math.log(self.N / (df + 1)) # added total number of words in doc
+            tf_idf[term] = (count / wordcount) * self.get_idf(term) # added total number of words in doc
         return tf_idf
 
     def tf_idf_query(self, docid, query) -> float:
-        tfs = self.index_reader.get_document_vector(docid)
+        tfs = self.get_document_vector(docid)
         wordcount = self.get_n_of_words_in_docid(docid)
         return sum([self.tf_idf_term(docid, term, wordcount=wordcount, tfs=tfs) for term in query])
 
+    def tf_idf_query_docidx(self, docidx, query) -> float:
+        """ tf_idf_query of a document given by its internal docidx """
+        tfs = self.get_document_vector_by_docidx(docidx)
+        wordcount = self.get_n_of_words_by_docidx(docidx)
+        return sum([self.tf_idf_term(None, term, wordcount=wordcount, tfs=tfs) for term in query])
+
     def bm25_term(self, docid, term, k1=0.9, b=0.4) -> float:
         return self.index_reader.compute_bm25_term_weight(docid, term, k1=k1, b=b, analyzer=None)
 
@@ -91,7 +157,7 @@ class Models:
 
     def bm25_docid(self, docid) -> {}:
         """ get all terms in documents """
-        tfs = self.index_reader.get_document_vector(docid)
+        tfs = self.get_document_vector(docid)
         bm25_vector = {term: self.index_reader.compute_bm25_term_weight(docid, term, analyzer=None) for term in tfs.keys()}
         return bm25_vector
 
@@ -105,187 +171,114 @@ class Models:
                 pass
         return score
       
-    def create_collection_list(self, top_k_docs):
-        """
-        Create list of all analyzed terms in the top-k documents.
-        """
-        for doc in top_k_docs:
-            self.top_k_doc_vec[doc] = self.index_reader.get_document_vector(doc)
-            for term in self.top_k_doc_vec[doc].keys():
-                if not term in self.c_list:
-                    self.c_list.append(term)
-        print(f"Length of collection terms list: {len(self.c_list)}")
-        #for term in itertools.islice(self.index_reader.terms(), 0, None):
-        #    self.c_list.append(term.term)
-        #    self.c_list = self.c_list[38734:193468] # c_list.index('a.')) #first 38734 elements are numbers, last are mostly symbols
-
-
-    def create_complete_vector(self, doc_vector):
-        """
-        Each term is represented as a dimension to be able to compare the documents.
-        For this, also the terms that are not present in the document should be added to the document vector.
-        """
-        complete_doc_vector = doc_vector
-        #print(f"Length of document vector before completing with collection list: {len(doc_vector)}")
-        for term in self.c_list:    
-            # TODO: smoothing of terms?
-            if not term in doc_vector:
-                complete_doc_vector[term] = 0
-        complete_dict = collections.OrderedDict(sorted(complete_doc_vector.items()))
-        complete_vector_list = complete_dict.values()
-        #print(f"Length after completing: {len(complete_vector_list)}")
-        return complete_vector_list
-            
-
-    def create_query_vector(self, q):
-        query_vector = {}
-        for t in q:
-            #if not t in query_vector:
-            query_vector[t] = 1 # =/= q.count(t), since BOW uses binary representation of the occurence of a term
-        complete_query_vector = self.create_complete_vector(query_vector)
-        return complete_query_vector
-
-
-    def get_relevance_dataframe(self):
+    def tf_idf_rows(self, docids, vocabulary):
         """
-        Read file with relevance of part of the collection.
+        Sparse tf-idf rows of docids as (indptr, indices, data), vocabulary maps term -> column
+        and is extended with unseen terms. Turn the rows into a matrix with rows_to_csr once all rows are known.
         """
-        self.relevance_data = pd.read_csv(self.qrelfile, sep=" ", header=None)
-        self.relevance_data.columns = ["topic_id", "round_id", "cord_uid", "relevancy"]
-
-        self.relevance_data = self.relevance_data[self.relevance_data.relevancy >= 0] # File contains 2 rows with -1
+        indptr, indices, data = [0], [], []
+        for docid in docids:
+            if self.doc_vectors is not None:
+                # Precomputed rows are used as they are, their terms are keyed on term id
+                term_ids, weights = self.doc_vectors.get_row(self.indexed_docidx(docid))
+                indices.extend(vocabulary.setdefault(int(t), len(vocabulary)) for t in term_ids)
+                data.extend(weights.tolist())
+            else:
+                for term, weight in self.tf_idf_docid(docid).items():
+                    indices.append(vocabulary.setdefault(term, len(vocabulary)))
+                    data.append(weight)
+            indptr.append(len(indices))
+        return indptr, indices, data
+
+    def term_key(self, term):
+        """ Vocabulary key of a query term, the same key tf_idf_rows uses for it """
+        if self.doc_vectors is not None:
+            term_id = self.term_stats.term_id(term)
+            if term_id >= 0:
+                return term_id
+        return term
+
+    def rows_to_csr(self, rows, n_terms):
+        indptr, indices, data = rows
+        return sp.csr_matrix((np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, n_terms))
+
+    def centroid(self, matrix):
+        """ Sparse 1 x n_terms mean of the rows of matrix, all zeros for an empty matrix """
+        if matrix.shape[0] == 0:
+            return sp.csr_matrix((1, matrix.shape[1]))
+        return sp.csr_matrix(np.ones((1, matrix.shape[0])) / matrix.shape[0]) @ matrix
+
+    def query_row(self, q, vocabulary):
+        """ Binary bag-of-words query vector, the occurrence of a term counts, not its frequency """
+        columns = sorted(set(vocabulary.setdefault(self.term_key(t), len(vocabulary)) for t in q))
+        return [0, len(columns)], columns, [1.0] * len(columns)
 
-    
     def get_relevance_docs(self, query_id, q, m, ordered_doc_scores):
         """
         Relevancy equals to 0 is irrelevant, 1 is relevant, and 2 is highly relevant.
         Ide dec-h algoritm: Take only the marked non-relevant document that received the highest score.
         """
-        self.get_relevance_dataframe()
-
-        relevant_docs = self.relevance_data[(self.relevance_data.topic_id == query_id) & (self.relevance_data.relevancy > 1)] # only highly relevant feedback?
+        relevant_docs = self.qrels.relevant(query_id, min_grade=2) # only highly relevant feedback?
+        non_relevant_docs = self.qrels.non_relevant(query_id) # Only use positive feedback ?
         if m == 'ide':
-            # Loop over ordered dict and compare with non-relevant docs to find doc with highest rank which should be non-relevant
-            # TODO: loop over actual top-k docs + scores
-
-            # Get set of non-relevant documents for current query
-            non_relevant_docs = self.relevance_data[(self.relevance_data.topic_id == query_id) & (self.relevance_data.relevancy == 0)]
-            print(f"Amount of non-relevant docs for current query: {len(non_relevant_docs.cord_uid)}")
-
-            # Check if one of the documents from the top-k documents are within this set
-            for doc in ordered_doc_scores:
-                non_relevant_top_k = non_relevant_docs[non_relevant_docs.cord_uid == doc]
-                if np.array(non_relevant_top_k.cord_uid) != []:
-                    # only get highest ranked document
-                    break
-            
-            non_relevant_docs = non_relevant_top_k
-            print(f"Non-relevant doc in the top-k docs: {non_relevant_docs}")
-        else:
-            non_relevant_docs = self.relevance_data[(self.relevance_data.topic_id == query_id) & (self.relevance_data.relevancy == 0)] # Only use positive feedback ?
-
-        # Add terms in relevant & non-relevant docs to the collection term list
-        # Create complete query vector accordingly.
-
-        self.create_collection_list(relevant_docs.cord_uid)
-        self.create_collection_list(non_relevant_docs.cord_uid)
-        
-        return [relevant_docs.cord_uid, non_relevant_docs.cord_uid]
-    
-
-    def rocchio_algorithm(self, qid, q0, top_docs, m):
-        print("in rocchio algorithm")
-        self.t.start()
-        doc_ids = self.get_relevance_docs(qid, q0, m, top_docs)
-        relevant_doc_ids = doc_ids[0]
-        non_relevant_doc_ids = doc_ids[1]
-
-        relevant_doc_vectors = []
-        for doc_id in tqdm(relevant_doc_ids):
-            relevant_doc_vectors.append(self.create_complete_vector(self.tf_idf_docid(doc_id)))
-        print("Got relevant vectors")
-        self.t.stop()
-
-        self.t.start()
-        non_relevant_doc_vectors = []
-        for doc_id in tqdm(non_relevant_doc_ids):
-            non_relevant_doc_vectors.append(self.create_complete_vector(self.tf_idf_docid(doc_id)))
-        print("Got non-relevant vectors")
-        self.t.stop()
+            instrumentation.note("ide.judged_non_relevant", docs=len(non_relevant_docs))
+
+            # Highest ranked document of the top-k that was judged non-relevant
+            non_relevant_top_k = next((doc for doc in ordered_doc_scores if self.qrels.grade(query_id, doc) == 0), None)
+            non_relevant_docs = [non_relevant_top_k] if non_relevant_top_k is not None else []
+            instrumentation.note("ide.top_k_non_relevant", docs=non_relevant_docs)
+
+        # Judged documents that are not in the index have no vector, leave them out of the centroids
+        indexed_relevant = [doc for doc in relevant_docs if self.get_docidx(doc) >= 0]
+        indexed_non_relevant = [doc for doc in non_relevant_docs if self.get_docidx(doc) >= 0]
+        instrumentation.count("feedback.unindexed", len(relevant_docs) + len(non_relevant_docs) - len(indexed_relevant) - len(indexed_non_relevant))
+        return [indexed_relevant, indexed_non_relevant]
+
+    def rocchio_algorithm(self, qid, q0, top_docs, m, vocabulary):
+        """ Modified query vector alpha * q0 + beta * relevant centroid - gamma * non-relevant centroid as a sparse row """
+        with instrumentation.span("rocchio.feedback_vectors"):
+            relevant_doc_ids, non_relevant_doc_ids = self.get_relevance_docs(qid, q0, m, top_docs)
+            relevant_rows = self.tf_idf_rows(relevant_doc_ids, vocabulary)
+            non_relevant_rows = self.tf_idf_rows(non_relevant_doc_ids, vocabulary)
+            query_row = self.query_row(q0, vocabulary)
 
         # Standard values
         alpha = 1.0
         beta = 0.75
         gamma = 0.15
 
-        # calculate centroid of relevant documents
-        self.t.start()
-        summed_relevant_vectors = np.zeros(len(relevant_doc_vectors[0]))
-        for doc in tqdm(relevant_doc_vectors): 
-            np.add(summed_relevant_vectors, np.array(list(doc)), summed_relevant_vectors)
-        centroid_relevant_docs = 1/len(relevant_doc_ids) * summed_relevant_vectors
-        print(f"centroid rel length: {len(centroid_relevant_docs)}")
-        self.t.stop()
-
-        self.t.start()
+        n_terms = len(vocabulary)
+        centroid_relevant_docs = self.centroid(self.rows_to_csr(relevant_rows, n_terms))
         # TODO: In practice, only use positive feedback (set gamma to 0) --> test this
-        # calculate centroid of non-relevant documents
-        if non_relevant_doc_vectors == []:
+        non_relevant_docs = self.rows_to_csr(non_relevant_rows, n_terms)
+        if non_relevant_docs.shape[0] == 0:
             # no non-relevant feedback
             gamma = 0
-            centroid_non_relevant_docs = 0
-        else:
-            summed_non_relevant_vectors = np.zeros(len(non_relevant_doc_vectors[0]))
-            for doc in tqdm(non_relevant_doc_vectors): 
-                summed_non_relevant_vectors = np.add(summed_non_relevant_vectors, np.array(list(doc)), summed_non_relevant_vectors)
-                centroid_non_relevant_docs = 1/len(non_relevant_doc_ids) * summed_non_relevant_vectors
-            print(f"centroid non-rel length: {len(centroid_non_relevant_docs)}")
-        self.t.stop()
-
-        complete_q0 = self.create_query_vector(q0)
-
-        self.t.start()
-        # rocchio algorithm    
-        q_mod = np.multiply(alpha, np.asarray(list(complete_q0))) + np.multiply(beta, np.asarray(centroid_relevant_docs)) - np.multiply(gamma, np.asarray(centroid_non_relevant_docs))
-        self.t.stop() 
+        centroid_non_relevant_docs = self.centroid(non_relevant_docs)
+
+        # rocchio algorithm
+        q_mod = alpha * self.rows_to_csr(query_row, n_terms) + beta * centroid_relevant_docs - gamma * centroid_non_relevant_docs
         return q_mod
 
+    @instrumentation.traced("rocchio")
     def rocchio_ranking(self, qid, q0, top_k_docs, model):
-        rocchio_timer = Timer()
-        rocchio_timer.start()
-        if self.c_list == []:
-            # start by adding query terms to the terms collection
-            for term in q0:
-                self.c_list.append(term)
-            # add the terms from the top-k documents
-            self.create_collection_list(top_k_docs)
-        print("in rocchio ranking")
-
-        q_mod = self.rocchio_algorithm(qid, q0, top_k_docs, model) # TODO: fix idh argument
-        print("got qmod")
-
-        # Check how many values are not 0 to check effect of relevance feedback 
-        q_mod_diff = [x for x in q_mod if x != 0.0]
-        print(f"q_mod non-zero terms: {len(q_mod_diff)}")
-
-        doc_scores = {}
-
-        count = 0
-
-        self.t.start()
-
-        # Rank documents using dot product as similarity function
-        for doc in tqdm(top_k_docs):
-            similarity_score = np.dot(np.array(list(self.create_complete_vector(self.tf_idf_docid(doc)))), q_mod)
-            doc_scores[doc] = similarity_score
-            #print(f"Doc nr.:{count} - Score: {similarity_score}")
-            #count += 1
-        self.t.stop()
-    
-        #print(doc_scores)
-        print("TOTAL ROCCHIO TIME: ")
-        rocchio_timer.stop()
-        self.c_list = []
+        # Terms are mapped to columns in the order they are first seen, only terms of the query,
+        # the top-k documents and the feedback documents ever get a column
+        vocabulary = {}
+        top_k_docs = list(top_k_docs)
+        with instrumentation.span("rocchio.top_k_vectors"):
+            top_k_rows = self.tf_idf_rows(top_k_docs, vocabulary)
+
+        q_mod = self.rocchio_algorithm(qid, q0, top_k_docs, model, vocabulary)
+
+        # Check how many values are not 0 to check effect of relevance feedback
+        instrumentation.note("rocchio.q_mod", nonzero=int(q_mod.count_nonzero()))
+
+        # Rank documents using dot product as similarity function, one sparse matrix-vector product
+        with instrumentation.span("rocchio.score"):
+            scores = (self.rows_to_csr(top_k_rows, len(vocabulary)) @ q_mod.T).toarray().ravel()
+            doc_scores = {doc: float(score) for doc, score in zip(top_k_docs, scores)}
         return doc_scores
 
 """
@@ -1,3 +1,5 @@
+import pytrec_eval
+
 def clear_output(filename):
     ''' clear output file '''
     open(filename, "w").close()
@@ -5,4 +7,67 @@ def clear_output(filename):
 def write_output(query_id, doc_id, ranking, score, name):
     ''' write output that can be parsed by the trec_eval evaluation engine. Used to compare our rankings to the human query relevance rankings for the CORD-19 set '''
     out = "{}\t{}\t{}\t{}\t  {:.6f}\t{}\n".format(str(query_id), "Q0", str(doc_id), ranking, score, name)
-    return out
\ No newline at end of file
+    return out
+class RunWriter:
+    '''
+    Collects a run in the {qid: {docid: score}} format of pytrec_eval while writing it as a TREC run file.
+    Lines are written in batches of buffer_lines, and the run is evaluated from memory: evaluate_topic scores
+    a topic as soon as it is ranked, evaluate scores the remaining topics and returns the whole evaluation.
+    '''
+
+    def __init__(self, filename, name, qrel=None, measures=None, buffer_lines=10000):
+        self.filename = filename
+        self.name = name
+        self.buffer_lines = buffer_lines
+        self.buffer = []
+        self.run = {}
+        self.qrel = qrel
+        self.measures = measures
+        self.evaluator = None
+        self.evaluation = {}
+        self.outfile = open(filename, "w")
+
+    def add_topic(self, query_id, results):
+        ''' Add the [(score, docid)] ranking of a topic '''
+        topic_run = self.run.setdefault(str(query_id), {})
+        for i, (score, doc_id) in enumerate(results, 1):
+            line = write_output(query_id, doc_id, i, score, self.name)
+            self.buffer.append(line)
+            # Keep the score as it is written, so evaluating from memory matches evaluating the file
+            topic_run[str(doc_id)] = float(line.split("\t")[4])
+        if len(self.buffer) >= self.buffer_lines:
+            self.flush()
+
+    def flush(self):
+        self.outfile.write("".join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_evaluator(self):
+        if self.evaluator is None:
+            measures = self.measures if self.measures is not None else pytrec_eval.supported_measures
+            self.evaluator = pytrec_eval.RelevanceEvaluator(self.qrel, measures)
+        return self.evaluator
+
+    def evaluate_topic(self, query_id):
+        ''' Measures of a single ranked topic, empty if the topic has no relevance judgements '''
+        query_id = str(query_id)
+        if query_id not in self.evaluation:
+            self.evaluation.update(self.get_evaluator().evaluate({query_id: self.run[query_id]}))
+        return self.evaluation.get(query_id, {})
+
+    def evaluate(self):
+        ''' Measures of every topic in the run, as returned by pytrec_eval '''
+        remaining = {query_id: docs for query_id, docs in self.run.items() if query_id not in self.evaluation}
+        if remaining:
+            self.evaluation.update(self.get_evaluator().evaluate(remaining))
+        return {query_id: self.evaluation[query_id] for query_id in self.run if query_id in self.evaluation}
@@ -0,0 +1,41 @@
+_loaded = {}
+
+def load_qrels(qrelfile):
+    """ Qrels of qrelfile, parsed only the first time it is asked for in this process """
+    if qrelfile not in _loaded:
+        _loaded[qrelfile] = Qrels(qrelfile)
+    return _loaded[qrelfile]
+
+class Qrels:
+    """
+    Relevance judgements per topic as {cord_uid: grade}, in file order.
+    Grade 0 is irrelevant, 1 is relevant and 2 is highly relevant, the file also contains a few -1 grades
+    which count as neither.
+    """
+
+    def __init__(self, qrelfile):
+        self.qrelfile = qrelfile
+        self.judgements = {}
+        with open(qrelfile) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                topic_id, _, cord_uid, grade = line.split()
+                self.judgements.setdefault(int(topic_id), {})[cord_uid] = int(grade)
+
+    def get_judgements(self, topic_id):
+        return self.judgements.get(int(topic_id), {})
+
+    def grade(self, topic_id, cord_uid):
+        """ Grade of cord_uid for the topic, None if it was not judged """
+        return self.get_judgements(topic_id).get(cord_uid)
+
+    def relevant(self, topic_id, min_grade=1):
+        return [doc for doc, grade in self.get_judgements(topic_id).items() if grade >= min_grade]
+
+    def non_relevant(self, topic_id):
+        return [doc for doc, grade in self.get_judgements(topic_id).items() if grade == 0]
+
+    def to_pytrec(self):
+        """ The qrels in the {qid: {docid: grade}} format of pytrec_eval.parse_qrel """
+        return {str(topic_id): dict(docs) for topic_id, docs in self.judgements.items()}
@@ -0,0 +1,77 @@
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+
+RESULT_CACHE = "blob/results.sqlite"
+
+def index_fingerprint(*paths):
+    """ Hash of the names, sizes and modification times of the files in the index directories """
+    digest = hashlib.sha1()
+    for path in paths:
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            digest.update("{0}\0{1}\0{2}\n".format(name, stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Two-tier cache of first-stage rankings: an in-memory LRU in front of a sqlite table. Entries are keyed
+    on the analyzed query terms, the model, its parameters and the index fingerprint, so a changed index
+    never serves stale rankings. A ranking stored for k documents also answers every request for fewer.
+    """
+
+    def __init__(self, fingerprint, path=RESULT_CACHE, max_entries=1024):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Several worker processes may share the file, wait for their writes instead of failing
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, k INTEGER, ranking TEXT)")
+        self.db.commit()
+
+    def key(self, terms, model, params):
+        key = json.dumps([self.fingerprint, model, sorted(params.items()), list(terms)])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, terms, model, params, k):
+        """ The [(score, docid)] top-k of the query, or None if no stored ranking covers k documents """
+        key = self.key(terms, model, params)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        else:
+            row = self.db.execute("SELECT k, ranking FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = (row[0], [tuple(item) for item in json.loads(row[1])])
+                self._remember(key, entry)
+        # A ranking shorter than its k holds every matching document, it is complete for any k
+        if entry is None or (entry[0] < k and len(entry[1]) >= entry[0]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1][:k]
+
+    def put(self, terms, model, params, k, ranking):
+        key = self.key(terms, model, params)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] >= k:
+            return
+        ranking = [(float(score), docid) for score, docid in ranking]
+        self._remember(key, (k, ranking))
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, k, json.dumps(ranking)))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+import trec_main
+
+RERANK_MODELS = ("none", "rocchio", "ide")
+STATUS_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+def init_worker(options):
+    """ Load the ranker once per worker, the BM25 postings engine is always loaded since requests pick the model """
+    trec_main.init_worker(dict(options, model="bm25"))
+
+def search_worker(task):
+    options, topic_id, query = task
+    result, _ = trec_main.rank_topic(trec_main._worker["ranker"], options, topic_id, query)
+    return [(docid, float(score)) for score, docid in result]
+
+class SearchServer:
+    """
+    Resident ranker behind a small HTTP/JSON API. Requests are parsed on the asyncio event loop and ranked
+    by a pool of worker processes that keep their JVM, indexes and doc table loaded between requests.
+    At most max_pending requests are queued or ranking, later requests get a 503 straight away.
+    """
+
+    def __init__(self, options, workers=1, max_pending=64):
+        self.options = options
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.served = 0
+        # spawn, the JVM does not survive a fork
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker, initargs=(options,))
+
+    def warm_up(self):
+        """ Rank one query in every worker, so the first requests do not pay for starting the JVMs """
+        futures = [self.pool.submit(search_worker, (self.options, 1, "coronavirus")) for _ in range(self.workers)]
+        concurrent.futures.wait(futures)
+
+    def parse_search(self, request):
+        """ Options and (topic, query) of a /search request body, raises ValueError on invalid input """
+        if not isinstance(request, dict) or not isinstance(request.get("query"), str):
+            raise ValueError("request needs a 'query' string")
+        options = dict(self.options)
+        options["model"] = request.get("model", options["model"])
+        options["k_docs"] = request.get("k", options["k_docs"])
+        options["rerank"] = request.get("rerank", options["rerank"])
+        if options["model"] not in trec_main.RANKING_FUNCTIONS:
+            raise ValueError("model should be one of {0}".format(", ".join(trec_main.RANKING_FUNCTIONS)))
+        if not isinstance(options["k_docs"], int) or options["k_docs"] < 1:
+            raise ValueError("k should be a positive integer")
+        if options["rerank"] not in RERANK_MODELS:
+            raise ValueError("rerank should be one of {0}".format(", ".join(RERANK_MODELS)))
+        topic_id = request.get("topic")
+        if options["rerank"] != "none" and topic_id is None:
+            raise ValueError("reranking uses the relevance judgements of a topic, pass its number as 'topic'")
+        return options, topic_id, request["query"]
+
+    async def search(self, body):
+        try:
+            task = self.parse_search(json.loads(body or b"null"))
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        if self.pending >= self.max_pending:
+            return 503, {"error": "too many pending requests"}
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.pool, search_worker, task)
+        except Exception as e:
+            return 500, {"error": "{0}: {1}".format(type(e).__name__, e)}
+        finally:
+            self.pending -= 1
+        self.served += 1
+        return 200, {
+            "results": [{"docid": docid, "score": score} for docid, score in result],
+            "took_ms": (time.perf_counter() - start) * 1000,
+        }
+
+    async def dispatch(self, method, target, body):
+        if target == "/search" and method == "POST":
+            return await self.search(body)
+        if target == "/health" and method == "GET":
+            return 200, {"status": "ok", "pending": self.pending, "served": self.served}
+        return 404, {"error": "no route for {0} {1}".format(method, target)}
+
+    async def handle(self, reader, writer):
+        """ One HTTP/1.1 request per connection """
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, response = await self.dispatch(method, target, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response = 400, {"error": "malformed request"}
+        payload = json.dumps(response).encode("utf-8")
+        writer.write("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\nConnection: close\r\n\r\n".format(
+            status, STATUS_REASONS.get(status, ""), len(payload)).encode("latin-1") + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix_socket=None):
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+            print("Serving on {0}".format(unix_socket))
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print("Serving on http://{0}:{1}".format(host, port))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="TREC-COVID document ranker server")
+    parser.add_argument("-v", "--verbose", help="Increase output verbosity", action="store_true", default=False)
+    parser.add_argument("--host", help="Address to listen on", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="Port to listen on", type=int, default=8000)
+    parser.add_argument("-u", "--unix_socket", help="Listen on this Unix socket instead of TCP", default=None)
+    parser.add_argument("-w", "--workers", help="Number of ranking processes", type=int, default=1)
+    parser.add_argument("--max_pending", help="Maximum number of requests queued or ranking at once", type=int, default=64)
+    parser.add_argument("-bi", "--binary_index", help="Serve postings, document vectors and term counts from the exported binary index", action="store_true", default=False)
+    parser.add_argument("-ts", "--term_stats", help="Read df/idf from the precomputed term statistics table", action="store_true", default=False)
+    parser.add_argument("-dv", "--doc_vectors", help="Read tf-idf document vectors from the precomputed store (needs -bi)", action="store_true", default=False)
+    parser.add_argument("-m", "--model", help="Default model of a request from {bm25, bm25_reference, tf_idf}", default="bm25")
+    parser.add_argument("-k", "--k_docs", help="Default number of documents to retrieve", type=trec_main.positive_int, default=100)
+    parser.add_argument("-r", "--rerank", help="Default rerank model 'rocchio', or 'ide'", default="none")
+    parser.add_argument("-rc", "--result_cache", help="Reuse first-stage rankings stored in the result cache", action="store_true", default=False)
+    parser.add_argument("--doc_cache_mb", help="Memory budget of the document vector cache in MB", type=int, default=256)
+    args = parser.parse_args()
+    options = dict(vars(args), doc_at_a_time=False, term_at_a_time=False, impact_index=False, fields=False, topic_fields="query", budget=None, pruning="none")
+
+    server = SearchServer(options, workers=args.workers, max_pending=args.max_pending)
+    print("Starting {0} ranking workers".format(args.workers))
+    server.warm_up()
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
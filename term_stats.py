@@ -0,0 +1,67 @@
+import json
+import os
+import numpy as np
+from progress.bar import Bar
+from binary_index import TermDictionary, write_term_dictionary
+
+def build_term_stats(index_reader, path):
+    """ Write the df/cf table of every term in the Lucene index, in the same layout the binary index uses """
+    stats = index_reader.stats()
+    bar = Bar("Collecting term statistics", max=stats['unique_terms'])
+    counts = {}
+    for term in index_reader.terms():
+        counts[term.term] = (term.df, term.cf)
+        bar.next()
+    bar.finish()
+    terms = sorted(counts, key=lambda t: t.encode("utf-8"))
+    write_term_dictionary(path, terms)
+    np.save(os.path.join(path, "df.npy"), np.asarray([counts[t][0] for t in terms], dtype=np.int32))
+    np.save(os.path.join(path, "cf.npy"), np.asarray([counts[t][1] for t in terms], dtype=np.int64))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"documents": stats['documents'], "unique_terms": len(terms)}, f)
+
+def exists(path):
+    return os.path.exists(os.path.join(path, "meta.json"))
+
+class TermStats:
+    """
+    df, cf and tf-idf idf (log(N / (df + 1))) of every term, loaded once from a term stats directory or
+    from a binary index. Terms are found with a binary search in the sorted term dictionary, lookups are memoized.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.N = json.load(f)["documents"]
+        self.terms = TermDictionary(path)
+        self.df_array = np.load(os.path.join(path, "df.npy"), mmap_mode="r")
+        self.cf_array = np.load(os.path.join(path, "cf.npy"), mmap_mode="r")
+        self.idf_array = np.log(self.N / (self.df_array + 1.0))
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __getitem__(self, term_id):
+        return self.terms[term_id]
+
+    def term_id(self, term):
+        """ Id of term in the sorted dictionary, -1 if it does not occur in the collection """
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = self.terms.lookup(term)
+        return term_id
+
+    def lookup(self, term):
+        return self.term_id(term)
+
+    def df(self, term):
+        term_id = self.term_id(term)
+        return int(self.df_array[term_id]) if term_id >= 0 else 0
+
+    def cf(self, term):
+        term_id = self.term_id(term)
+        return int(self.cf_array[term_id]) if term_id >= 0 else 0
+
+    def idf(self, term):
+        term_id = self.term_id(term)
+        return float(self.idf_array[term_id]) if term_id >= 0 else float(np.log(self.N))
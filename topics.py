@@ -0,0 +1,100 @@
+import hashlib
+import math
+import os
+import pickle
+import xml.etree.ElementTree as ET
+
+TOPICS_DIR = "blob/topics"
+FIELDS = ("query", "question", "narrative")
+# Part of the cache key, a compiled topics file of another format is never read
+FORMAT_VERSION = 2
+
+def parse_topics(topicsfilename):
+    """ {topic number: {field: text}} of a TREC topics file """
+    topics = {}
+    root = ET.parse(topicsfilename).getroot()
+    for topic in root.findall("topic"):
+        topic_number = topic.attrib["number"]
+        topics[topic_number] = {}
+        for field in FIELDS:
+            for element in topic.findall(field):
+                topics[topic_number][field] = element.text
+    return topics
+
+def parse_fields(text):
+    """ Topic fields from a comma separated list like "query,question" """
+    fields = tuple(field.strip() for field in text.split(","))
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("Unknown topic field {0}, fields are {1}".format(field, ", ".join(FIELDS)))
+    return fields
+
+class Topic:
+    """
+    A topic with its text and analyzed terms per field. Compiled against a binary index, every term also
+    carries its term id, df and BM25 idf, -1/0 for terms not in the index. The term ids let the index skip
+    the term dictionary search when the topic is ranked.
+    """
+
+    def __init__(self, number, text, terms):
+        self.number = number
+        self.text = text
+        self.terms = terms
+        self.compiled = {}
+
+    def compile(self, index):
+        N = index.stats()["non_empty_documents"]
+        for term in {term for terms in self.terms.values() for term in terms}:
+            term_id = index.term_id(term)
+            df = int(index.df[term_id]) if term_id >= 0 else 0
+            self.compiled[term] = (term_id, df, math.log(1 + (N - df + 0.5) / (df + 0.5)) if term_id >= 0 else 0.0)
+
+    def term_ids(self):
+        """ {term: term id} of every compiled term, including the -1 of terms that are not in the index """
+        return {term: term_id for term, (term_id, _, _) in self.compiled.items()}
+
+    def query(self, fields=("query",)):
+        """ Text of the fields combined into one query """
+        return " ".join(self.text[field] for field in fields if self.text.get(field))
+
+    def query_terms(self, fields=("query",)):
+        """ Analyzed terms of query(fields), the terms of the fields one after the other """
+        return [term for field in fields if self.text.get(field) for term in self.terms[field]]
+
+def cache_file_for(topicsfile, index_path=None, cache_dir=TOPICS_DIR):
+    """
+    Compiled topics file for a topics file, keyed on its contents and, when compiled against a binary index,
+    on the metadata of that index, so an edited topics file or a new index gets freshly compiled topics
+    """
+    digest = hashlib.sha1(str(FORMAT_VERSION).encode("utf-8"))
+    with open(topicsfile, "rb") as f:
+        digest.update(f.read())
+    if index_path is not None:
+        with open(os.path.join(index_path, "meta.json"), "rb") as f:
+            digest.update(f.read())
+        digest.update(str(os.stat(os.path.join(index_path, "postings.bin")).st_mtime_ns).encode("utf-8"))
+    name = os.path.splitext(os.path.basename(topicsfile))[0]
+    return os.path.join(cache_dir, "{0}-{1}.pickle".format(name, digest.hexdigest()[:12]))
+
+def load_topics(topicsfile, analyze, index=None, cache_dir=TOPICS_DIR):
+    """
+    Topics of a topics file ordered on their number, parsed, analyzed and compiled once and read from the
+    cache afterwards. analyze maps text to its terms, index is an optional BinaryIndex to compile against.
+    """
+    cache_file = cache_file_for(topicsfile, index.path if index is not None else None, cache_dir)
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    topics = []
+    for number, text in parse_topics(topicsfile).items():
+        topic = Topic(int(number), text, {field: list(analyze(text[field])) if text.get(field) else [] for field in FIELDS})
+        if index is not None:
+            topic.compile(index)
+        topics.append(topic)
+    topics.sort(key=lambda topic: topic.number)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump(topics, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return topics
@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 import argparse
-import itertools
 import json
-import xml.etree.ElementTree as ET
+import multiprocessing
 import sys
 import heapq
 import pickle
@@ -10,16 +9,43 @@ import time
 import os
 from pyserini.index import IndexReader
 from pyserini.search import SimpleSearcher
-from pyserini.analysis import Analyzer, get_lucene_analyzer
 from progress.bar import Bar
 import pytrec_eval
-from output import write_output
+from output import RunWriter
 from models import Models
-from index_trec import Index, InvertedList
+from qrels import load_qrels
+from index_trec import Index
+from engine import PostingsEngine
+from analysis import QueryAnalyzer
+import daat
+import instrumentation
+from binary_index import BinaryIndex, export_index
+import doc_table
+import term_stats
+from term_stats import TermStats
+from doc_cache import DocumentVectorCache
+import doc_vectors
+from doc_vectors import DocumentVectors
+from doc_table import DocTable
+import impact_index
+import tune
+import topics
+import field_index
+import ingest
+from field_index import BM25F
+from analysis import get_analyzer
+from result_cache import ResultCache, index_fingerprint, RESULT_CACHE
+from impact_index import ImpactIndex
 
 LUCENE_INDEX = "lucene-index-cord19-abstract-2020-07-16"
 QRELFILE = "input/qrels-covid_d5_j0.5-5.txt"
 TOPICSFILE = "input/topics-rnd5.xml"
+BINARY_INDEX = "blob/index"
+DOC_TABLE = "blob/doctable"
+TERM_STATS = "blob/termstats"
+DOC_VECTORS = "blob/docvectors"
+IMPACT_INDEX = "blob/impact"
+FIELD_INDEX = "blob/fields"
 
 def dummy_document_at_a_time(query, index, models, k):
     L = []
@@ -52,70 +78,58 @@ def dummy_document_at_a_time(query, index, models, k):
         print(result)
     return result
 
-def document_at_a_time(query, index, models, k, docidx_docid):
-    L = []
-    R = []
-    for term in analyze_query(query):
-        l = index.get_inverted_list(term)
-        L.append(l)
-    # Sort array of inverted lists by smallest list first
-    L = sorted(L, key=lambda item: item.get_list_len())
-    d = -1
-    found = []
-    longest_doc = None
-    finished = False
-    while(not finished):
-        score = 0
-        for l in L:
-            doc = l.get_current_doc()
-            if doc is None:
-                continue
-            doc_length = docidx_docid[doc][1]
-            if doc_length > d:
-                d = doc_length
-                longest_doc = doc
-        assert d != -1
-        assert d == index.get_n_of_words_in_inverted_list_doc(longest_doc)
-        for l in L:
-            l.skip_forward_to_document(longest_doc)
-            if l.get_current_doc() == longest_doc:
-                # score += models.bm25_term(index.get_docid_from_index(longest_doc), l.get_term())
-                docid = docidx_docid[longest_doc][0]
-                score += models.bm25_term(docid, l.get_term())
-                # score += models.tf_idf_term(docid, l.get_term())
-                l.increment()
-            else:
-                d = -1
-        if d > -1 and not docid in found:
-            if len(R) < k:
-                heapq.heappush(R, (score, docidx_docid[longest_doc][0]))
-            else:
-                heapq.heappushpop(R, (score, docidx_docid[longest_doc][0]))
-            found.append(docid)
-        finished = any([l.is_finished() for l in L])
-    result = sorted([(score, doc_id) for score, doc_id in R], key=lambda item : item[0], reverse=True)
+def document_at_a_time(query, engine, k, docidx_docid, pruning="none", stats=None):
+    # Lists in query term order, daat adds the scores of a document in that order like score_query does
+    L = [engine.get_inverted_list(term) for term in analyze_query(query)]
+    R, query_stats = daat.document_at_a_time(L, k, pruning=pruning)
+    instrumentation.count("candidates.scored", query_stats["scored"])
+    if verbose:
+        print("Scored {0} documents, skipped {1} postings".format(query_stats["scored"], query_stats["skipped"]))
+    if stats is not None:
+        for key, value in query_stats.items():
+            stats[key] = stats.get(key, 0) + value
+    result = [(score, docidx_docid[docidx][0]) for score, docidx in R]
+    if verbose:
+        print(result)
+    return result
+
+def term_at_a_time(query, engine, k, docidx_docid, maxscore=True, stats=None):
+    R, query_stats = engine.score_query_taat(analyze_query(query), k, maxscore=maxscore)
+    instrumentation.count("candidates.scored", query_stats["accumulators"])
+    if verbose:
+        print("Created {0} accumulators, skipped {1} postings".format(query_stats["accumulators"], query_stats["skipped"]))
+    if stats is not None:
+        for key, value in query_stats.items():
+            stats[key] = stats.get(key, 0) + value
+    result = [(score, docidx_docid[docidx][0]) for score, docidx in R]
     if verbose:
         print(result)
     return result
 
-def parse_topics(topicsfilename):
-    topics = {}
-    root = ET.parse(topicsfilename).getroot()
-    for topic in root.findall("topic"):
-        topic_number = topic.attrib["number"]
-        topics[topic_number] = {}
-        for query in topic.findall("query"):
-            topics[topic_number]["query"] = query.text
-        for question in topic.findall("question"):
-            topics[topic_number]["question"] = question.text
-        for narrative in topic.findall("narrative"):
-            topics[topic_number]["narrative"] = narrative.text
-    return topics
+def score_at_a_time(query, impacts, k, docidx_docid, budget=None, stats=None):
+    R, query_stats = impacts.score_query(analyze_query(query), k, budget=budget)
+    instrumentation.count("postings.read", query_stats["postings"])
+    if verbose:
+        print("Read {0} postings, skipped {1} postings".format(query_stats["postings"], query_stats["skipped"]))
+    if stats is not None:
+        for key, value in query_stats.items():
+            stats[key] = stats.get(key, 0) + value
+    result = [(score, docidx_docid[docidx][0]) for score, docidx in R]
+    if verbose:
+        print(result)
+    return result
+
+def bm25f(query, field_engine, k, stats=None):
+    R = field_engine.score_query(analyze_query(query), k)
+    instrumentation.count("candidates.returned", len(R))
+    result = [(score, field_engine.doc_table.docid(docidx)) for score, docidx in R]
+    if verbose:
+        print(result)
+    return result
 
 def write_topics_to_json(filename):
-    topics = parse_topics(filename)
     with open("topics.json", "w+") as outfile:
-        json.dump(topics, outfile)
+        json.dump(topics.parse_topics(filename), outfile)
 
 def read_json_topics(filename):
     with open(filename, "r") as infile:
@@ -127,8 +141,8 @@ def preprocess_query(query):
     return [word for word in query.split() if word not in stop_words]
 
 def score_query_heap(query, ranking_function, docs, index_class, models_class, k):
+    """ Top-k of the candidate docidx on ranking_function, as [(score, docidx)] sorted on descending score """
     R = []
-    count = 0
     if verbose:
         print(query)
         bar = Bar("Computing scores for query", max=(len(docs)))
@@ -138,14 +152,17 @@ def score_query_heap(query, ranking_function, docs, index_class, models_class, k
         score = ranking_function(models_class, doc, query)
         if verbose:
             bar.next()
+        # -doc, so on equal scores the lowest docidx stays in the heap like in the postings engine
         if len(R) < k:
-            heapq.heappush(R, (score, doc))
+            heapq.heappush(R, (score, -doc))
         else:
-            heapq.heappushpop(R, (score, doc))
+            heapq.heappushpop(R, (score, -doc))
     if verbose:
         bar.finish()
+    instrumentation.count("candidates.scored", len(docs))
+    instrumentation.count("heap.operations", len(docs))
     # models_class.reset_df_vector()
-    return sorted([(score, doc_id) for score, doc_id in R], key=lambda item : item[0], reverse=True)
+    return sorted([(score, -doc) for score, doc in R], key=lambda item: (-item[0], item[1]))
 
 def score_query(query, ranking_function, docs, index_class, models_class):
     doc_scores = {}
@@ -167,34 +184,50 @@ def score_query(query, ranking_function, docs, index_class, models_class):
     return doc_scores
 
 def score_tf_idf(m_class, doc, query):
-    return m_class.tf_idf_query(doc, query)
+    return m_class.tf_idf_query_docidx(doc, query)
 
 k1_param = 0.9
 b_param = 0.4
 def score_bm25(m_class, doc, query):
-    return m_class.bm25_query_score(doc, query, k1=k1_param, b=b_param)
+    # Lucene's reference BM25 takes the external docid
+    return m_class.bm25_query_score(m_class.get_docid(doc), query, k1=k1_param, b=b_param)
+
+# Measures printed per topic by --stream_eval
+STREAM_MEASURES = ("map", "ndcg_cut_10", "P_10", "recall_100")
+
+RANKING_FUNCTIONS = {"bm25": None, "bm25_reference": score_bm25, "tf_idf": score_tf_idf}
+
+query_analyzer = QueryAnalyzer()
 
 def analyze_query(query):
-    analyzer = Analyzer(get_lucene_analyzer())
-    query = analyzer.analyze(query)
-    return query
+    return query_analyzer.analyze(query)
 
-def get_docs_and_score_query(query, ranking_function, index_class, models_class, topic_id, k, docidx_docid, rerank="none"):
-    docs_list = []
+def get_docs_and_score_query(query, ranking_function, index_class, models_class, topic_id, k, docidx_docid, rerank="none", engine=None,
+        result_cache=None, model=None):
     if verbose:
         print("Analyzing query..")
     query = analyze_query(query)
-    if verbose:
-        print("Retrieving documents for query terms..")
-    for term in query:
-        docs = index_class.get_docids_from_postings(term, docidx_docid, debug=False)
-        print(term)
-        print(len(docs))
-        docs_list.append(docs)
-    docs = set(itertools.chain.from_iterable(docs_list))
-    if verbose:
-        print("Ranking..")
-    doc_scores = score_query_heap(query, ranking_function, docs, index_class, models_class, k)
+    # First-stage rankings are cached before reranking, so changing only the reranker reuses them
+    params = {"k1": k1_param, "b": b_param} if model in ("bm25", "bm25_reference") else {}
+    doc_scores = result_cache.get(query, model, params, k) if result_cache is not None else None
+    if doc_scores is not None:
+        if verbose:
+            print("Using cached ranking..")
+    elif engine is not None:
+        if verbose:
+            print("Ranking with postings engine..")
+        doc_scores = [(score, docidx_docid[docidx][0]) for score, docidx in engine.score_query(query, k)]
+    else:
+        if verbose:
+            print("Retrieving documents for query terms..")
+        docs = index_class.get_candidates(query)
+        if verbose:
+            print("Ranking..")
+        # Candidates stay docidx while scoring, only the top-k is converted to docids
+        doc_scores = [(score, docidx_docid[docidx][0])
+            for score, docidx in score_query_heap(query, ranking_function, docs.tolist(), index_class, models_class, k)]
+    if result_cache is not None:
+        result_cache.put(query, model, params, k, doc_scores)
     # print(doc_scores)
 
     if rerank != "none":
@@ -213,115 +246,306 @@ def get_docs_and_score_query(query, ranking_function, index_class, models_class,
 
     return doc_scores
 
-def pytrec_dictionary_entry(qid, docid, score):
-    """ Create dictionary entry to update the total run output for pytrec_eval """
-    return {
-                'q' + str(qid) : {
-                    str(docid) : score
-                }
-            }
-
 def pytrec_evaluation(runfile, qrelfile, measures = pytrec_eval.supported_measures):
     """ run trec_eval with "measures" from the Python interface """
     with open(runfile, "r") as ranking:
         run = pytrec_eval.parse_run(ranking)
-    with open(qrelfile, "r") as qrel:
-        qrel = pytrec_eval.parse_qrel(qrel)
+    # Shares the qrels Models already parsed for relevance feedback
+    qrel = load_qrels(qrelfile).to_pytrec()
 
     evaluator = pytrec_eval.RelevanceEvaluator(
         qrel, measures)
 
     return evaluator.evaluate(run)
 
-def construct_lookup_table(filename, models, index, docidx_docid):
-    """ function to construct TF-IDF DOCID vector look-up table """
-    lookup_table = {}
-    bar = Bar("Creating tf-idf dictionary", max=(index.get_max_docindex()))
-    for doc in range(index.get_max_docindex()):
-        try:
-            docid = docidx_docid[doc][0]
-            doclen = docidx_docid[doc][1]
-            lookup_table[doc] = models.tf_idf_docid(docid, doclen)
-            bar.next()
-        except:
-            print("Error!")
-            continue
-    bar.finish()
-    with open(filename, 'wb') as handle:
-        pickle.dump(lookup_table, handle, protocol=pickle.HIGHEST_PROTOCOL)
-    print("Dumped dictionary")
+def load_ranker(options, index_reader=None, searcher=None):
+    """ Open the indexes and scoring state needed to rank topics with options, once per process """
+    if index_reader is None:
+        index_reader = IndexReader(LUCENE_INDEX)
+        searcher = SimpleSearcher(LUCENE_INDEX)
+    if instrumentation.enabled():
+        # Count every call that goes through the JVM
+        index_reader = instrumentation.CountingProxy(index_reader)
+        searcher = instrumentation.CountingProxy(searcher)
+    binary_index = BinaryIndex(BINARY_INDEX) if options["binary_index"] else None
+    docidx_docid = DocTable(DOC_TABLE)
+    # The binary index already holds the df/cf table, otherwise use the separately built one
+    stats_table = None
+    if binary_index is not None:
+        stats_table = TermStats(BINARY_INDEX)
+    elif options["term_stats"]:
+        stats_table = TermStats(TERM_STATS)
+    doc_cache = DocumentVectorCache(index_reader, max_bytes=options["doc_cache_mb"] * 1024 * 1024,
+        binary_index=binary_index, doc_table=docidx_docid, terms=stats_table)
+    ranker = {
+        "docidx_docid": docidx_docid,
+        "models": Models(index_reader, QRELFILE, binary_index=binary_index, doc_table=docidx_docid, term_stats=stats_table, doc_cache=doc_cache,
+            doc_vectors=DocumentVectors(DOC_VECTORS) if options["doc_vectors"] else None),
+        "index": Index(index_reader, searcher, binary_index=binary_index, doc_cache=doc_cache),
+        "doc_cache": doc_cache,
+        "engine": None,
+        "impact_index": ImpactIndex(IMPACT_INDEX) if options["impact_index"] else None,
+        "field_engine": BM25F(FIELD_INDEX, field_index.parse_weights(options["field_weights"]), k1=k1_param, b=b_param)
+            if options["fields"] else None,
+        "result_cache": ResultCache(index_fingerprint(LUCENE_INDEX)) if options["result_cache"] else None,
+    }
+    if options["model"] == "bm25" or options["doc_at_a_time"] or options["term_at_a_time"]:
+        ranker["engine"] = PostingsEngine(index_reader, docidx_docid.lengths, k1=k1_param, b=b_param, binary_index=binary_index)
+    # The impact index shares the term dictionary of the binary index it was built from
+    for index in (binary_index, ranker["impact_index"]):
+        if index is not None:
+            index.terms.add_term_ids(compiled_term_ids)
+    return ranker
+
+def rank_topic(ranker, options, idx, query):
+    """ Rank a single topic, returns the [(score, docid)] ranking and the statistics of the algorithm """
+    with instrumentation.query(idx), instrumentation.span("rank_topic", topic=idx):
+        return _rank_topic(ranker, options, idx, query)
+
+def _rank_topic(ranker, options, idx, query):
+    stats = {}
+    k = options["k_docs"]
+    if options["doc_at_a_time"]:
+        result = document_at_a_time(query, ranker["engine"], k, ranker["docidx_docid"], pruning=options["pruning"], stats=stats)
+    elif options["term_at_a_time"]:
+        result = term_at_a_time(query, ranker["engine"], k, ranker["docidx_docid"], maxscore=options["pruning"] == "maxscore", stats=stats)
+    elif options["fields"]:
+        result = bm25f(query, ranker["field_engine"], k, stats=stats)
+    elif options["impact_index"]:
+        result = score_at_a_time(query, ranker["impact_index"], k, ranker["docidx_docid"], budget=options["budget"], stats=stats)
+    else:
+        # The postings engine only computes BM25, other models score through Models
+        engine = ranker["engine"] if options["model"] == "bm25" else None
+        result = get_docs_and_score_query(query, RANKING_FUNCTIONS[options["model"]], ranker["index"], ranker["models"], idx, k,
+            ranker["docidx_docid"], rerank=options["rerank"], engine=engine, result_cache=ranker["result_cache"], model=options["model"])
+    return result, stats
+
+# Term ids of the compiled topics in the binary index, handed to the term dictionaries of load_ranker
+compiled_term_ids = {}
+
+def load_topics(options):
+    """ Compiled topics of TOPICSFILE, with the analyzed terms of their combined fields seeded into the query memo """
+    index = BinaryIndex(BINARY_INDEX) if options["binary_index"] else None
+    topic_list = topics.load_topics(TOPICSFILE, get_analyzer().analyze, index)
+    fields = topics.parse_fields(options["topic_fields"])
+    for topic in topic_list:
+        query_analyzer._store(topic.query(fields), topic.query_terms(fields))
+        compiled_term_ids.update(topic.term_ids())
+    return topic_list, fields
+
+_worker = {}
+
+def init_worker(options):
+    """ Process pool initializer, every worker ranks with its own readers on top of the shared memory-mapped files """
+    global verbose
+    verbose = options["verbose"]
+    load_topics(options)
+    _worker["options"] = options
+    _worker["ranker"] = load_ranker(options)
+
+def rank_topic_worker(task):
+    idx, query = task
+    return rank_topic(_worker["ranker"], _worker["options"], idx, query)
+
+def run_tune(args, options, tasks, index_reader, searcher, current_time):
+    """ Grid search k1/b on the postings of all topics, fetched once through the postings engine """
+    ranker = load_ranker(dict(options, model="bm25"), index_reader, searcher)
+    measures = args.tune_measures.split(",")
+    k1_grid, b_grid = tune.parse_grid(args.k1_grid), tune.parse_grid(args.b_grid)
+    print("Evaluating {0} settings of k1 and b".format(len(k1_grid) * len(b_grid)))
+    results = tune.grid_search(ranker["engine"], ranker["docidx_docid"], [(idx, analyze_query(query)) for idx, query in tasks],
+        load_qrels(QRELFILE).to_pytrec(), k1_grid, b_grid, measures=measures, k=args.k_docs,
+        workers=args.workers if args.workers > 1 else None)
+    tune.print_results(results, measures)
+    with open("output/tune-{0}.json".format(current_time), 'w') as outjson:
+        json.dump([{"k1": k1, "b": b, **scores} for (k1, b), scores in results], outjson)
+
+def positive_int(text):
+    """ argparse type of a number of documents, k = 0 has no ranking to return """
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("{0} is not a positive integer".format(text))
+    return value
 
 def run():
     parser = argparse.ArgumentParser(description="TREC-COVID document ranker CLI")
     parser.add_argument("-v", "--verbose", help="Increase output verbosity", action="store_true", default=False)
-    parser.add_argument("-cp", "--compute_pickle", help="Compute mapping from internal lucene id's to external docid's", action="store_true", default=False)
+    parser.add_argument("-cp", "--compute_pickle", help="Compute table mapping internal lucene id's to external docid's and lengths", action="store_true", default=False)
+    parser.add_argument("-e", "--export_index", help="Export the Lucene index once to the binary index in {0}".format(BINARY_INDEX), action="store_true", default=False)
+    parser.add_argument("-bi", "--binary_index", help="Serve postings, document vectors and term counts from the exported binary index", action="store_true", default=False)
+    parser.add_argument("-ts", "--term_stats", help="Read df/idf from the precomputed term statistics table (built on first use)", action="store_true", default=False)
+    parser.add_argument("-bv", "--build_doc_vectors", help="Precompute tf-idf and BM25 vectors of all documents from the binary index to {0}".format(DOC_VECTORS), action="store_true", default=False)
+    parser.add_argument("-dv", "--doc_vectors", help="Read tf-idf document vectors from the precomputed store (needs -bi)", action="store_true", default=False)
     parser.add_argument("-n", "--n_queries", help="Naximum number of queries to run", type=int, default=999)
-    parser.add_argument("-m", "--model", help="which model used in ranking from {bm25, tf_idf}", default="bm25")
+    parser.add_argument("-m", "--model", help="which model used in ranking from {bm25, bm25_reference, tf_idf}", default="bm25")
     parser.add_argument("-d", "--doc_at_a_time", help="Use document_at_a_time algorithm", action="store_true", default=False)
-    parser.add_argument("-k", "--k_docs", help="Numer of documents to retrieve", type=int, default=100)
+    parser.add_argument("-t", "--term_at_a_time", help="Use term_at_a_time algorithm", action="store_true", default=False)
+    parser.add_argument("--pruning", help="Dynamic pruning, {none, wand, bmw} for document_at_a_time and {none, maxscore} for term_at_a_time",
+        choices=daat.PRUNING_MODES + ("maxscore",), default="none")
+    parser.add_argument("-s", "--score_at_a_time", dest="impact_index", help="Use score_at_a_time over the quantized impact-ordered index (needs -bi, built on first use)",
+        action="store_true", default=False)
+    parser.add_argument("-b", "--budget", help="Maximum number of postings score_at_a_time reads per query", type=int, default=None)
+    parser.add_argument("--build_fields", help="Index title, abstract and full text body of the CORD-19 metadata.csv at this path into {0}".format(FIELD_INDEX), default=None)
+    parser.add_argument("-f", "--fields", help="Rank with BM25F over the title, abstract and body fields", action="store_true", default=False)
+    parser.add_argument("--field_weights", help="BM25F weights, for example 'title=2,abstract=1,body=0.5'", default="title=2,abstract=1,body=0.5")
+    parser.add_argument("--topic_fields", help="Comma separated topic fields combined into the query, from query, question and narrative", default="query")
+    parser.add_argument("-k", "--k_docs", help="Numer of documents to retrieve", type=positive_int, default=100)
     parser.add_argument("-r", "--rerank", help="Which rerank model to use 'rocchio', or 'ide'", default="none")
+    parser.add_argument("-rc", "--result_cache", help="Reuse first-stage rankings stored in {0}".format(RESULT_CACHE), action="store_true", default=False)
+    parser.add_argument("--doc_cache_mb", help="Memory budget of the document vector cache in MB", type=int, default=256)
+    parser.add_argument("-se", "--stream_eval", help="Print the main measures of every topic as soon as it is ranked", action="store_true", default=False)
+    parser.add_argument("--tune", help="Grid search BM25 k1/b on the topics instead of writing a run", action="store_true", default=False)
+    parser.add_argument("--k1_grid", help="k1 values of the grid search, 'start:stop:step' or a comma separated list", default="0.5:1.5:0.1")
+    parser.add_argument("--b_grid", help="b values of the grid search, 'start:stop:step' or a comma separated list", default="0.1:1.0:0.1")
+    parser.add_argument("--tune_measures", help="Comma separated measures of the grid search, the first one picks the best setting", default="map,ndcg_cut_10,P_10")
+    parser.add_argument("--profile", help="Write the time spent per span and the counters, per run and per topic, as JSON to this file", default=None)
+    parser.add_argument("--trace", help="Write every span in Chrome trace format to this file", default=None)
+    parser.add_argument("-w", "--workers", help="Number of processes to rank topics with", type=int, default=1)
     args = parser.parse_args()
     global verbose
     verbose = args.verbose
     model = args.model
     doc_at_a_time = args.doc_at_a_time
-    k = args.k_docs
-    rerank = args.rerank
+    term_at_a_time = args.term_at_a_time
+    if sum((doc_at_a_time, term_at_a_time, args.impact_index, args.fields)) > 1:
+        print("Use only one of document_at_a_time, term_at_a_time, score_at_a_time or BM25F!")
+        sys.exit(1)
+    if (doc_at_a_time and args.pruning == "maxscore") or (term_at_a_time and args.pruning in ("wand", "bmw")):
+        print("Pruning '{0}' is not available for this algorithm!".format(args.pruning))
+        sys.exit(1)
+
+    if args.profile or args.trace:
+        if args.workers > 1:
+            print("Profiling only covers the main process, use -w 1 to profile the ranking itself")
+        instrumentation.enable(trace=args.trace is not None)
 
     index_reader = IndexReader(LUCENE_INDEX)
     searcher = SimpleSearcher(LUCENE_INDEX)
-    models = Models(index_reader, QRELFILE)
-    trec_index = Index(index_reader, searcher)
+
+    if args.export_index:
+        print("Exporting binary index to {0}".format(BINARY_INDEX))
+        export_index(index_reader, BINARY_INDEX)
 
     if not os.path.exists('output'):
         os.makedirs('output')
 
     if args.compute_pickle:
-        print("Computing id index dict")
-        docidx_docid = {docidx : (trec_index.get_docid_from_index(docidx), trec_index.get_n_of_words_in_inverted_list_doc(docidx)) for docidx in range(trec_index.get_max_docindex())}
-        with open('blob/mapping.pickle', 'wb') as handle:
-            pickle.dump(docidx_docid, handle, protocol=pickle.HIGHEST_PROTOCOL)
-    if True:
+        print("Computing id index table")
+        doc_table.build_doc_table(DOC_TABLE, LUCENE_INDEX, index_reader.stats()['documents'],
+            binary_index_path=BINARY_INDEX if args.binary_index else None)
+    elif not doc_table.exists(DOC_TABLE):
+        # One-off conversion of the old pickled dict, avoids rebuilding the table through the JVM
         with open('blob/mapping.pickle', 'rb') as handle:
-            print("Loading id index dict")
-            docidx_docid = pickle.load(handle)
-        print("Finished initializing id index dict")
+            print("Converting id index dict to table")
+            doc_table.from_mapping(pickle.load(handle), DOC_TABLE)
 
-    topics = parse_topics(TOPICSFILE)
+    if (args.build_doc_vectors or args.doc_vectors) and not args.binary_index:
+        print("The document vector store is computed from the binary index, use -bv/-dv together with -bi!")
+        sys.exit(1)
+    if args.build_doc_vectors or (args.doc_vectors and not doc_vectors.exists(DOC_VECTORS, BINARY_INDEX, k1=k1_param, b=b_param)):
+        print("Computing document vectors")
+        doc_vectors.build_doc_vectors(DOC_VECTORS, BINARY_INDEX, k1=k1_param, b=b_param, workers=args.workers if args.workers > 1 else None)
 
-    rocchio = False
-    if model == "bm25":
-        rankfun = score_bm25
-    elif model == "tf_idf":
-        rankfun = score_tf_idf
-    else:
-        print("Model should be 'tf_idf' or 'bm25' (default)!")
+    if args.impact_index and not args.binary_index:
+        print("The impact index is built from the binary index, use -s together with -bi!")
+        sys.exit(1)
+    if args.impact_index and not impact_index.exists(IMPACT_INDEX, k1=k1_param, b=b_param, binary_index_path=BINARY_INDEX):
+        print("Building impact index for k1={0}, b={1}".format(k1_param, b_param))
+        impact_index.build_impact_index(IMPACT_INDEX, BINARY_INDEX, k1=k1_param, b=b_param)
+
+    if args.build_fields:
+        print("Building field index from {0}".format(args.build_fields))
+        os.makedirs(FIELD_INDEX, exist_ok=True)
+        checkpoint = os.path.join(FIELD_INDEX, "ingest.json")
+        stats = {}
+        batches = ingest.ingest(args.build_fields, workers=args.workers if args.workers > 1 else None, checkpoint=checkpoint, stats=stats)
+        field_index.build_field_index(FIELD_INDEX, batches, get_analyzer().analyze, checkpoint=checkpoint)
+        print(ingest.throughput(stats))
+    if args.fields and not field_index.exists(FIELD_INDEX):
+        print("There is no field index yet, build it with --build_fields metadata.csv!")
         sys.exit(1)
 
+    if args.term_stats and not args.binary_index and not term_stats.exists(TERM_STATS):
+        print("Building term statistics table")
+        term_stats.build_term_stats(index_reader, TERM_STATS)
+
+    if model not in RANKING_FUNCTIONS:
+        print("Model should be 'tf_idf', 'bm25_reference' or 'bm25' (default)!")
+        sys.exit(1)
+    options = vars(args)
+
     t = time.localtime()
     current_time = time.strftime("%H:%M", t)
     rankfile = "output/ranking-{0}-{1}.txt".format(model, current_time)
     resultfile = "output/results-{0}-{1}.json".format(model, current_time)
 
     if doc_at_a_time:
-        try:
-            with open(rankfile, 'w') as outfile:
-                for idx in range(1, min(args.n_queries+1, len(topics)+1)):
-                    for i, (score, docid) in enumerate(document_at_a_time(topics[str(idx)]["query"], trec_index, models, k, docidx_docid), 1):
-                        outfile.write(write_output(idx, docid, i, score, "document_at_a_time"))
-        finally:
-            outfile.close()
+        run_name = "document_at_a_time"
+    elif term_at_a_time:
+        run_name = "term_at_a_time"
+    elif args.impact_index:
+        run_name = "score_at_a_time"
+    elif args.fields:
+        run_name = "bm25f"
+    else:
+        run_name = "score_query"
+
+    # Topics are analyzed once and compiled to blob/topics, repeated runs and the workers analyze nothing
+    topic_list, fields = load_topics(options)
+    tasks = [(topic.number, topic.query(fields)) for topic in topic_list[:args.n_queries]]
+    if verbose:
+        for topic in topic_list[:args.n_queries]:
+            print("Topic {0}: {1}".format(topic.number, " ".join("{0} (df {1}, idf {2:.2f})".format(term, *topic.compiled[term][1:3])
+                if term in topic.compiled else term for term in topic.query_terms(fields))))
+    if args.tune:
+        run_tune(args, options, tasks, index_reader, searcher, current_time)
+        return
+
+    pool = None
+    if args.workers > 1:
+        # Every worker opens its own index readers, spawn because the JVM of this process does not survive a fork
+        pool = multiprocessing.get_context("spawn").Pool(args.workers, initializer=init_worker, initargs=(options,))
+        # imap hands back the rankings in topic order, so the run file is identical to a serial run
+        ranked = pool.imap(rank_topic_worker, tasks)
     else:
-        try:
-            with open(rankfile, 'w') as outfile:
-                for idx in range(1, min(args.n_queries+1, len(topics)+1)):
-                    for i, (score, docid) in enumerate(
-                        get_docs_and_score_query(topics[str(idx)]["query"], rankfun, trec_index, models, idx, k, docidx_docid, rerank=rerank), 1):
-                        outfile.write(write_output(idx, docid, i, score, "score_query"))
-        finally:
-            outfile.close()
-
-    results = pytrec_evaluation(rankfile, QRELFILE)
+        ranker = load_ranker(options, index_reader, searcher)
+        ranked = (rank_topic(ranker, options, idx, query) for idx, query in tasks)
+    run_stats = {}
+    try:
+        with RunWriter(rankfile, run_name, qrel=load_qrels(QRELFILE).to_pytrec()) as writer:
+            for (idx, _), (result, stats) in zip(tasks, ranked):
+                writer.add_topic(idx, result)
+                if args.stream_eval:
+                    measures = writer.evaluate_topic(idx)
+                    print("Topic {0}: {1}".format(idx, "  ".join("{0} {1:.4f}".format(measure, measures[measure])
+                        for measure in STREAM_MEASURES if measure in measures) or "not judged"))
+                for key, value in stats.items():
+                    run_stats[key] = run_stats.get(key, 0) + value
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if verbose and pool is None:
+        print("Document vector cache: {0}".format(ranker["doc_cache"].stats()))
+        if ranker["result_cache"] is not None:
+            print("Result cache: {0}".format(ranker["result_cache"].stats()))
+    if doc_at_a_time:
+        print("document_at_a_time ({0} pruning): scored {1} documents, skipped {2} postings".format(
+            args.pruning, run_stats.get("scored", 0), run_stats.get("skipped", 0)))
+    elif term_at_a_time:
+        print("term_at_a_time ({0} pruning): created {1} accumulators, skipped {2} postings".format(
+            args.pruning, run_stats.get("accumulators", 0), run_stats.get("skipped", 0)))
+    elif args.impact_index:
+        print("score_at_a_time (budget {0}): read {1} postings, skipped {2} postings".format(
+            args.budget if args.budget is not None else "none", run_stats.get("postings", 0), run_stats.get("skipped", 0)))
+
+    if args.profile:
+        instrumentation.export_json(args.profile)
+    if args.trace:
+        instrumentation.export_chrome_trace(args.trace)
+
+    # Evaluated from the rankings in memory, the run file is not read back
+    results = writer.evaluate()
     with open(resultfile, 'w') as outjson:
         json.dump(results, outjson)
 
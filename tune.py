@@ -0,0 +1,89 @@
+import itertools
+import multiprocessing
+import numpy as np
+import pytrec_eval
+from engine import top_k
+
+def parse_grid(text):
+    """ Grid values from a comma separated list "0.6,0.9,1.2" or an inclusive range "start:stop:step" """
+    if ":" in text:
+        start, stop, step = (float(value) for value in text.split(":"))
+        return [round(value, 10) for value in np.arange(start, stop + step / 2, step)]
+    return [float(value) for value in text.split(",")]
+
+def measure_family(measure):
+    """ Measure name to pass to RelevanceEvaluator, ndcg_cut_10 is computed by ndcg_cut and P_10 by P """
+    family, _, cutoff = measure.rpartition("_")
+    return family if family and cutoff.isdigit() else measure
+
+class TopicPostings:
+    """
+    Everything BM25 needs of one query, fetched once: for every posting of every query term its idf, tf and
+    Lucene document length, plus the index of its document among the unique candidates of the query.
+    """
+
+    def __init__(self, topic_id, engine, query):
+        self.topic_id = str(topic_id)
+        idfs, docs_list, tfs_list = [], [], []
+        for term in query:
+            docs, tfs = engine.get_postings(term)
+            idfs.append(np.full(len(docs), engine.idf(len(docs))))
+            docs_list.append(docs)
+            tfs_list.append(tfs)
+        docs = np.concatenate(docs_list or [np.empty(0, dtype=np.int32)])
+        self.idf = np.concatenate(idfs or [np.empty(0)])
+        self.tfs = np.concatenate(tfs_list or [np.empty(0)]).astype(np.float64)
+        self.doc_lengths = engine.doc_lengths[docs].astype(np.float64)
+        self.candidates, self.inverse = np.unique(docs, return_inverse=True)
+
+    def rank(self, k1, b, avgdl, k):
+        """ [(score, docidx)] BM25 top-k of the query for (k1, b) """
+        if len(self.candidates) == 0:
+            return []
+        norms = k1 * (1 - b + b * self.doc_lengths / avgdl)
+        scores = np.bincount(self.inverse, weights=self.idf * self.tfs / (self.tfs + norms), minlength=len(self.candidates))
+        return top_k(self.candidates, scores, k)
+
+_worker = {}
+
+def _init_worker(topics, docids, qrel, measures, avgdl, k):
+    _worker.update(topics=topics, docids=docids, qrel=qrel, measures=measures, avgdl=avgdl, k=k)
+
+def _evaluate_point(point):
+    return evaluate_point(point, **_worker)
+
+def evaluate_point(point, topics, docids, qrel, measures, avgdl, k):
+    """ Mean of every measure over the topics for one (k1, b) """
+    k1, b = point
+    run = {}
+    for topic in topics:
+        run[topic.topic_id] = {docids[docidx]: score for score, docidx in topic.rank(k1, b, avgdl, k)}
+    evaluator = pytrec_eval.RelevanceEvaluator(qrel, {measure_family(measure) for measure in measures})
+    evaluation = evaluator.evaluate(run)
+    return {measure: float(np.mean([topic[measure] for topic in evaluation.values()])) if evaluation else 0.0
+        for measure in measures}
+
+def grid_search(engine, docidx_docid, queries, qrel, k1_grid, b_grid, measures=("map",), k=100, workers=None):
+    """
+    Evaluate BM25 for every (k1, b) in the grid on the same postings, fetched once from the engine.
+    queries is a list of (topic id, analyzed query). Returns [((k1, b), {measure: mean})] in grid order.
+    """
+    topics = [TopicPostings(topic_id, engine, query) for topic_id, query in queries]
+    # Candidates are the same for every point, resolve their docids once
+    docids = {int(docidx): docidx_docid[int(docidx)][0] for topic in topics for docidx in topic.candidates}
+    grid = list(itertools.product(k1_grid, b_grid))
+    if workers is None or workers <= 1:
+        return [(point, evaluate_point(point, topics, docids, qrel, measures, engine.avgdl, k)) for point in grid]
+    # spawn, the parent process runs a JVM which does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(topics, docids, qrel, measures, engine.avgdl, k)) as pool:
+        return list(zip(grid, pool.map(_evaluate_point, grid)))
+
+def print_results(results, measures):
+    """ Table of the grid, followed by the best point on the first measure """
+    print("{0:>6} {1:>6} ".format("k1", "b") + " ".join("{0:>12}".format(measure) for measure in measures))
+    for (k1, b), scores in results:
+        print("{0:>6.2f} {1:>6.2f} ".format(k1, b) + " ".join("{0:>12.4f}".format(scores[measure]) for measure in measures))
+    (k1, b), scores = max(results, key=lambda item: item[1][measures[0]])
+    print("Best {0}: {1:.4f} at k1={2}, b={3}".format(measures[0], scores[measures[0]], k1, b))
+    return k1, b